@@ -1,21 +1,57 @@
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 import random
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-import json
+import orjson
+import joblib
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from scipy.sparse import csr_matrix, vstack
+from sklearn.cluster import MiniBatchKMeans, kmeans_plusplus
+from sklearn.preprocessing import normalize
+import copy
+from types import MappingProxyType
 import os
+import sys
 import logging
 import re
 from nltk.tokenize import word_tokenize
 from nltk.corpus import stopwords
 import nltk
-from collections import defaultdict
+from collections import defaultdict, Counter
+from functools import lru_cache
+from itertools import islice
+import threading
 import time
+import uuid
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+try:
+    from liburing import (
+        io_uring, io_uring_cqes, io_uring_queue_init, io_uring_get_sqe, io_uring_prep_write,
+        io_uring_submit, io_uring_wait_cqe, io_uring_cqe_seen
+    )
+except ImportError:
+    io_uring = None
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -32,7 +68,56 @@ except LookupError:
     nltk.download('punkt_tab', quiet=True)
     nltk.download('stopwords', quiet=True)
 
-app = FastAPI(title="AI-Driven Query Response API")
+if njit is not None:
+    @njit(cache=True, parallel=True, fastmath=True)
+    def lloyd_kernel(X, centroids, max_iter):
+        """Compiled Lloyd's iterations; updates centroids in place and returns labels."""
+        n, d = X.shape
+        k = centroids.shape[0]
+        labels = np.zeros(n, dtype=np.int64)
+        n_chunks = min(n, 64)
+        for _ in range(max_iter):
+            # Assignment and centroid accumulation fused into one pass over X, with per-chunk
+            # buffers so parallel chunks never write the same sums; reduced after the pass
+            sums = np.zeros((n_chunks, k, d), dtype=X.dtype)
+            counts = np.zeros((n_chunks, k), dtype=np.int64)
+            changed = np.zeros(n_chunks, dtype=np.int64)
+            for chunk in prange(n_chunks):
+                for i in range(chunk * n // n_chunks, (chunk + 1) * n // n_chunks):
+                    best = 0
+                    best_distance = 1e38
+                    for c in range(k):
+                        distance = 0.0
+                        for j in range(d):
+                            t = X[i, j] - centroids[c, j]
+                            distance += t * t
+                        if distance < best_distance:
+                            best_distance = distance
+                            best = c
+                    if labels[i] != best:
+                        changed[chunk] += 1
+                    labels[i] = best
+                    counts[chunk, best] += 1
+                    for j in range(d):
+                        sums[chunk, best, j] += X[i, j]
+            if changed.sum() == 0:
+                break
+            for c in range(k):
+                total = counts[:, c].sum()
+                if total > 0:
+                    for j in range(d):
+                        acc = 0.0
+                        for chunk in range(n_chunks):
+                            acc += sums[chunk, c, j]
+                        centroids[c, j] = acc / total
+        return labels
+
+    # Compile (or load from the on-disk cache) at import, keeping JIT cost off the request path
+    lloyd_kernel(np.zeros((2, 1), dtype=np.float32), np.zeros((1, 1), dtype=np.float32), 1)
+else:
+    lloyd_kernel = None
+
+app = FastAPI(title="AI-Driven Query Response API", default_response_class=ORJSONResponse)
 
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -55,6 +140,131 @@ class QueryRequest(BaseModel):
     """Pydantic model for query request payload."""
     query: str
 
+class PartialWriteError(OSError):
+    """A log append that landed only in part; the first complete_lines lines of the buffer made it."""
+
+    def __init__(self, complete_lines, written, size):
+        super().__init__(f"Short training log write: {written} of {size} bytes")
+        self.complete_lines = complete_lines
+
+class AppendLog:
+    """Append-only log writer using io_uring when available, os.write otherwise."""
+
+    def __init__(self, path, ring_entries=32):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        if fcntl is not None:
+            # Held while the log is open, so compaction can tell when no other worker still appends to it
+            fcntl.flock(self.fd, fcntl.LOCK_SH)
+        self.ring = None
+        self._cqes = None
+        self._lock = threading.Lock()
+        if io_uring is None:
+            return
+        try:
+            ring = io_uring()
+            io_uring_queue_init(ring_entries, ring, 0)
+            self.ring = ring
+            self._cqes = io_uring_cqes()
+            logger.info(f"Using io_uring for training log at {path}")
+        except Exception as e:
+            logger.warning(f"io_uring init failed ({str(e)}), falling back to os.write")
+            self.ring = None
+
+    def write(self, buf):
+        """Append a buffer to the log, raising OSError unless all of it landed."""
+        if not buf:
+            return
+        with self._lock:
+            sqe = None if self.ring is None else io_uring_get_sqe(self.ring)
+            if sqe is None:
+                written = os.write(self.fd, buf)
+            else:
+                # The fd is O_APPEND, so the kernel appends regardless of the offset given here.
+                io_uring_prep_write(sqe, self.fd, buf, len(buf), 0)
+                io_uring_submit(self.ring)
+                # One write in flight at a time, so a failed or short one is reported to the caller that made it
+                io_uring_wait_cqe(self.ring, self._cqes)
+                cqe = self._cqes[0]
+                written = cqe.res
+                io_uring_cqe_seen(self.ring, cqe)
+                if written < 0:
+                    raise OSError(-written, os.strerror(-written))
+            if written < len(buf):
+                # Other workers may have appended since, so finishing the line here could land it elsewhere;
+                # end the torn line instead, and replay drops it as corrupt
+                if written and buf[written - 1:written] != b"\n":
+                    os.write(self.fd, b"\n")
+                raise PartialWriteError(buf.count(b"\n", 0, written), written, len(buf))
+
+    def try_lock_exclusive(self):
+        """Take the log exclusively if no other worker has it open; True on success."""
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            fcntl.flock(self.fd, fcntl.LOCK_SH)  # A failed lock conversion may have dropped the shared lock
+            return False
+
+    def unlock_exclusive(self):
+        """Downgrade an exclusive lock back to the shared one held while appending."""
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_SH)
+
+    def truncate(self):
+        """Empty the log; only safe under the exclusive lock."""
+        os.ftruncate(self.fd, 0)
+
+class HashedTfidfVectorizer:
+    """TF-IDF over hashed term counts, so each document is tokenized once and refits only reweight."""
+
+    def __init__(self, max_features=100, n_features=2 ** 18, stop_words='english', dtype=np.float32):
+        self.max_features = max_features
+        self.dtype = dtype
+        self.hasher = HashingVectorizer(
+            n_features=n_features, alternate_sign=False, norm=None, stop_words=stop_words, dtype=dtype
+        )
+        self.columns = None  # Hashed term columns kept, the max_features most frequent
+        self.transformer = None
+
+    def count(self, docs):
+        """Hash documents to raw term counts; stateless, so the result can be cached."""
+        return self.hasher.transform(docs)
+
+    def select_columns(self, counts):
+        """Sorted hashed term columns of the max_features most frequent terms in the counts."""
+        totals = np.asarray(counts.sum(axis=0)).ravel()
+        present = np.flatnonzero(totals)
+        if not len(present):
+            raise ValueError("empty vocabulary; perhaps the documents only contain stop words")
+        return np.sort(present[np.argsort(-totals[present], kind="stable")[:self.max_features]])
+
+    def vocabulary_overlap(self, counts):
+        """Jaccard overlap between the fitted vocabulary and the one the counts would select."""
+        columns = self.select_columns(counts)
+        shared = len(np.intersect1d(self.columns, columns, assume_unique=True))
+        return shared / (len(self.columns) + len(columns) - shared)
+
+    def fit_counts(self, counts):
+        """Select the most frequent terms and fit IDF weights from term counts, returning TF-IDF rows."""
+        self.columns = self.select_columns(counts)
+        self.transformer = TfidfTransformer()
+        return self.transformer.fit_transform(counts[:, self.columns]).astype(self.dtype, copy=False)
+
+    def transform_counts(self, counts):
+        """Weight term counts with the fitted IDF."""
+        return self.transformer.transform(counts[:, self.columns]).astype(self.dtype, copy=False)
+
+    def fit_transform(self, docs):
+        """Fit on documents and return their TF-IDF rows."""
+        return self.fit_counts(self.count(docs))
+
+    def transform(self, docs):
+        """Return TF-IDF rows for documents."""
+        return self.transform_counts(self.count(docs))
+
 class PersonalizedAI:
     """Personalized AI with optimized NLP and response generation."""
     
@@ -96,12 +306,46 @@ class PersonalizedAI:
                 "I didn't quite catch '{query}'. Could you provide more details so I can assist you better?"
             ]
         }
+        # Templates pre-split around their single {query} placeholder
+        self.intent_template_parts = {
+            intent: tuple((prefix, suffix) for prefix, _, suffix in (t.partition("{query}") for t in templates))
+            for intent, templates in self.intent_templates.items()
+        }
+        dynamic_templates = [
+            "Regarding {query}, {action}",
+            "For {query}, {action}",
+            "About {query}, {action}"
+        ]
+        dynamic_actions = [
+            "visit our website for details",
+            "check our support page",
+            "contact support for help"
+        ]
+        # Every dynamic template/action combination, pre-split around {query}
+        self.dynamic_response_parts = tuple(
+            (prefix, suffix.replace("{action}", action))
+            for prefix, _, suffix in (t.partition("{query}") for t in dynamic_templates)
+            for action in dynamic_actions
+        )
+        template_parts = self.intent_template_parts
+
+        @lru_cache(maxsize=1024)
+        def render_templates(intent, query_lower):
+            """Intent templates rendered for one lowercased query, shared across repeats of it."""
+            parts = template_parts.get(intent, template_parts["unknown"])
+            return tuple(prefix + query_lower + suffix for prefix, suffix in parts)
+
+        self.render_templates = render_templates
         self.learned_phrases = defaultdict(str)
         self.query_cache = {}  # Cache for preprocessed queries
         self.stop_words = set(stopwords.words('english'))
+        self._rng = random.Random()
 
     def preprocess_query(self, query):
         """Optimized query preprocessing."""
+        processed = self.query_cache.get(query)  # Hits without lowering when given an already-lowercased query
+        if processed is not None:
+            return processed
         query_lower = query.lower()
         if query_lower in self.query_cache:
             return self.query_cache[query_lower]
@@ -126,621 +370,1181 @@ class PersonalizedAI:
             self.learned_phrases[processed_query] = intent
             logger.debug(f"Learned phrase: '{processed_query}' -> {intent}")
 
-    def generate_dynamic_response(self, query, intent):
-        """Generate a dynamic response."""
-        templates = [
-            "Regarding {query}, {action}",
-            "For {query}, {action}",
-            "About {query}, {action}"
-        ]
-        actions = [
-            "visit our website for details",
-            "check our support page",
-            "contact support for help"
-        ]
-        return random.choice(templates).format(query=query.lower(), action=random.choice(actions))
+    def generate_dynamic_response(self, query_lower, intent):
+        """Generate a dynamic response for a lowercased query."""
+        prefix, suffix = self._rng.choice(self.dynamic_response_parts)
+        return prefix + query_lower + suffix
 
-    def generate_response(self, query, used_responses):
-        """Generate a response with optimized logic."""
-        intent = self.detect_intent(query)
+    def generate_response(self, query, used_responses, intent=None):
+        """Generate a response with optimized logic, reusing the caller's detected intent when given."""
+        if intent is None:
+            intent = self.detect_intent(query)
         self.learn_phrase(query, intent)
-        templates = self.intent_templates.get(intent, self.intent_templates["unknown"])
-        available_templates = [t for t in templates if t.format(query=query.lower()) not in used_responses]
+        query_lower = query.lower()
+        available_templates = [
+            rendered for rendered in self.render_templates(intent, query_lower) if rendered not in used_responses
+        ]
         if not available_templates:
-            response = self.generate_dynamic_response(query, intent)
+            response = self.generate_dynamic_response(query_lower, intent)
             logger.debug(f"Generated dynamic response for '{query}': {response}")
             return response
-        response = random.choice(available_templates).format(query=query.lower())
+        response = self._rng.choice(available_templates)
         logger.debug(f"Selected template response for '{query}': {response}")
         return response
 
+# Predefined responses for specific query categories; shared read-only by every instance and forked worker
+_QUERY_RESPONSE_MAP = MappingProxyType({
+    "greeting": {
+        "keywords": ("hello", "hi", "greetings", "welcome"),
+        "responses": (
+            "Hello and welcome to Flix! I'm here to assist you. How may I help you today?",
+            "Greetings and welcome to Flix. How may I assist you?",
+            "Welcome to Flix! My name is your assistant. How can I help you?",
+            "Hi, Welcome to Flix, I am your assistant. How may I assist you?"
+        )
+    },
+    "appreciation": {
+        "keywords": ("thank you", "reaching out", "contacted", "reporting"),
+        "responses": (
+            "I appreciate that you have reached out to us with your query.",
+            "Thank you for reaching out with your inquiry.",
+            "I am grateful that you contacted us regarding your concern.",
+            "I appreciate that you are reporting to us about this concern. I will look into it immediately."
+        )
+    },
+    "verification_details": {
+        "keywords": ("booking number", "pnr", "passenger name", "verify"),
+        "responses": (
+            "Sure, I'm here to help. To assist you effectively, please provide the following details: Booking number or PNR Number, Passenger's full name, Booking email address or booking phone number. Once you share this information, I'll be able to assist you promptly.",
+            "Certainly, I'm ready to assist you. To ensure I can help you effectively, please provide the following details: Booking number, Passenger's full name, Booking email address or booking phone number. Once you provide these details, I'll be able to assist you accordingly."
+        )
+    },
+    "processing_time": {
+        "keywords": ("checking", "moment", "please wait"),
+        "responses": (
+            "Thank you for sharing the details. Please allow me a moment to look for your concern.",
+            "Thank you for providing the information. Please allow me a moment to check with the details.",
+            "Thank you for sharing these details. Just a moment, please, I'm checking on the same."
+        )
+    },
+    "extended_processing": {
+        "keywords": ("still checking", "more time"),
+        "responses": (
+            "I am still checking your booking/ride details. Please be with me.",
+            "I got booking however need to check the issue with your ride."
+        )
+    },
+    "patience_appreciation": {
+        "keywords": ("patience", "thank you for waiting"),
+        "responses": (
+            "Thank you so much for your patience.",
+            "I really appreciate your patience.",
+            "Thank you so much for notifying me about the issue.",
+            "Thank you for reaching out to me about this.",
+            "I will get your issue resolved positively.",
+            "I appreciate your patience in this matter.",
+            "Your patience is appreciable."
+        )
+    },
+    "board_from_other_location": {
+        "keywords": ("board from other", "change boarding", "different location"),
+        "responses": (
+            "May I know why you want to change the boarding point and make it to other? As per the T&C, your ticket is valid for the boarding location to booked for and I regret to inform that boarding from other location isn't possible. Link: https://help.flixbus.com/s/article/PSSPCan-I-board-the-bus-at-a-later-stop?language=en_IN",
+            "I understand your preference for boarding the bus from your desired location. However, to ensure a smooth process, we kindly ask you to board from the designated location where the QR code can be scanned by the bus staff. Link: https://help.flixbus.com/s/article/PSSPCan-I-board-the-bus-at-a-later-stop?language=en_IN",
+            "While I appreciate your desire to board the bus from a different location, please note that the process requires the QR code to be scanned by the host at the specified boarding point. We recommend using the designated location for a seamless experience. Link: https://help.flixbus.com/s/article/PSSPCan-I-board-the-bus-at-a-later-stop?language=en_IN",
+            "I understand your request to board the bus from your chosen location. Unfortunately, due to our procedures, the QR code must be scanned by the host at the specified point. We encourage you to use the designated boarding location for a smooth transition. Link: https://help.flixbus.com/s/article/PSSPCan-I-board-the-bus-at-a-later-stop?language=en_IN",
+            "Thank you for your understanding. Although we recognize your preferred boarding location, our process mandates that the QR code be scanned by the host at the assigned area. For a hassle-free experience, please board from the designated location. Link: https://help.flixbus.com/s/article/PSSPCan-I-board-the-bus-at-a-later-stop?language=en_IN"
+        )
+    },
+    "boarding_point_details": {
+        "keywords": ("boarding point", "where to board"),
+        "responses": (
+            "The ticket contains essential details such as the boarding points, bus route number, a link in the bottom right corner, and a GPS link that can be accessed by clicking on the boarding point for more information.",
+            "You can find important information on the ticket, including boarding points, the bus route number, a link at the bottom right corner, and a GPS link accessible by clicking on the boarding point.",
+            "The ticket provides various details, such as the boarding points, the bus route number, a link located in the bottom right corner, and a GPS link available by clicking on the boarding point for further information."
+        )
+    },
+    "price_difference": {
+        "keywords": ("price difference", "why price change", "fare change"),
+        "responses": (
+            "I would like to inform you that as the prices are dynamic in nature and may change on the website with time.",
+            "Please note that our prices are dynamically adjusted based on demand, availability, and other factors to ensure the best possible experience for all our passengers.",
+            "To provide you with the most accurate and fair pricing, our rates are dynamically updated. We recommend booking early to secure the best available price.",
+            "We always recommend our passengers about a price lock feature where the price shown at the time of selection is reserved for 10 minutes, allowing passengers to complete their booking at the same rate within this timeframe. Delays in booking beyond this period may result in price adjustments.",
+            "We suggest booking early and utilizing the price lock feature to secure the most favorable fare."
+        )
+    },
+    "pre_departure_call": {
+        "keywords": ("pre departure call", "call before departure"),
+        "responses": (
+            "I completely understand that you are expecting a call from the bus staff. Please note that pre-departure calls are not mandatory however, the host might call you before arriving at your departure point. We appreciate your understanding.",
+        )
+    },
+    "bus_delay": {
+        "keywords": ("bus late", "bus delay", "delayed bus"),
+        "responses": (
+            "I regret to inform you that the bus is running late due to some operational reason and apologize for the inconvenience caused due to delay. So requesting you to please be available on the boarding point as the ride has already been departed from the previous boarding point and now going to reach your boarding point as quickly as possible. I appreciate your understanding.",
+            "I’m sincerely apologizing for the delay of the ride and sorry for the inconvenience caused to you. I would like to inform you that due to some operational reason the ride has been delayed and our operational team is trying to manage the delay and reach out your boarding point as soon as possible.",
+            "I regret to inform you that due to the heavy traffic the ride got stuck and now it’s get back on the track and the operational team is trying to manage that delay and reach out to your boarding point as quickly as possible. We need your patience and understanding in this matter."
+        )
+    },
+    "missed_bus": {
+        "keywords": ("missed bus", "miss bus", "left behind"),
+        "responses": (
+            "We see you as a valued customer and do not wish to leave you behind. However, it’s necessary to move the bus on schedule, as we have a commitment to punctuality. I sincerely apologize for the inconvenience caused by missing the bus.",
+            "We appreciate you as a valued customer and have no intention of leaving you behind. At the same time, we must adhere to the bus's scheduled departure time for the sake of punctuality. I understand how frustrating this can be, and I’m here to help you any further assistance you may need.",
+            "We truly value you as a customer, and it’s not in our interest to leave you behind. However, we also have to ensure the bus departs on time, as punctuality is essential. Please help me with the booking reference number or the PNR number for verification process so that I can help you with the information associated with your journey with Flix."
+        )
+    },
+    "bus_host_number": {
+        "keywords": ("bus number", "host number", "driver number"),
+        "responses": (
+            "I really apologize that I am unable to provide the bus number however you may identify your ride through the route number mentioned on the ticket and it gets displayed in front of the bus as well.",
+            "I regret to inform you that we don't have access to the bus driver or host's contact information. So, we always request our passengers to be at the pickup point 15 minutes prior to the departure, You may track your ride through the tracing link mentioned on the ticket."
+        )
+    },
+    "where_is_bus": {
+        "keywords": ("where is bus", "bus location", "track bus"),
+        "responses": (
+            "As checked, the ride is for your booked route. So, I would like to inform you that the ride will arrive at the boarding point as per the mentioned time on the ticket. I’m requesting you to please be present at the boarding point 15 minutes before the departure time of the bus, so that you can easily board the bus. Here I’m sharing the bus route number which is mentioned on the ticket just under the boarding point details and it’s also available in front of the bus from which you can easily recognize your bus. Tracking Link: https://global.flixbus.com/track/order/3242800682",
+            "I’m requesting you to please be available on the boarding point 15 minutes before the departure time of the bus, so that you can easily board the bus. Have a safe and pleasant journey ahead with Flix. Tracking Link: https://global.flixbus.com/track/order/3242800682"
+        )
+    },
+    "where_is_boarding_point": {
+        "keywords": ("boarding point location", "where is boarding point"),
+        "responses": (
+            "As checked the ticket is for your booked route. This is the address of your boarding point. This is the Google map link for the exact boarding point location. I’m requesting you to please be available on the boarding point 15 minutes before the departure time of the bus, so that you can easily board the bus. Have a safe and pleasant journey ahead with Flix.",
+        )
+    },
+    "pax_running_late": {
+        "keywords": ("running late", "late to board", "wait for me"),
+        "responses": (
+            "Extremely sorry to inform you that the bus will depart from the boarding point as per the scheduled time so requesting you to please try to reach the boarding point before the mentioned time on the ticket and ensure not to miss the bus.",
+            "Unfortunately, the bus cannot wait for the delayed passengers. Our buses travel within a network and are bound to follow a timetable. Please ensure that you are at the stop at least 15 minutes before departure. If you realize that you’re not going to reach in time, you can cancel your ride up to 15 minutes before departure via manage my booking of our website. Link: https://shop.flixbus.in/rebooking/login"
+        )
+    },
+    "ride_cancellation": {
+        "keywords": ("ride cancelled", "bus cancelled", "cancellation"),
+        "responses": (
+            "I’m really sorry for the inconvenience caused to you due to the ride cancellation and I would like to inform you that due to some operational reason the ride has been cancelled and after cancellation a self-help link has been provided to you via email with the booking email id. So requesting you to please check the email inbox along with the spam folder for the same and after clicking on that link you will be able to book an alternative ride completely free of cost for any other day you want or you may cancel the trip and generate a full ticket refund for yourself which will be credited to the source account within 7 working days.",
+            "I’m really sorry for the inconvenience caused to you due to the ride cancellation. Or if you want I can help you with the full ticket refund by cancelling the ticket from our end and the refund will be credited to the source account within 7 working days excluding Saturday, Sunday and Public holidays/ Bank holidays. With your permission should I proceed with the refund?"
+        )
+    },
+    "no_show_refund_denial": {
+        "keywords": ("no show", "missed bus refund", "didn't board"),
+        "responses": (
+            "I deeply apologize for the inconvenience you're experiencing, and I understand your frustration. I'm unable to proceed with either the refund or booking an alternative ride for you at this time. As per our company policy, in such cases where the service has been provided as intended, we are unable to process a refund. Link: https://www.flixbus.in/terms-and-conditions-of-carriage, clause number 12.2.5",
+            "After thoroughly investigating the incident, we confirmed that the bus arrived at the designated boarding point, other passengers boarded successfully, and the bus departed after the scheduled time. Regrettably, under these circumstances, we are unable to issue a refund for your ticket. Link: https://www.flixbus.in/terms-and-conditions-of-carriage, clause number 12.2.5"
+        )
+    },
+    "booking_changes_denial": {
+        "keywords": ("change booking", "modify booking"),
+        "responses": (
+            "Once your ticket is booked, we are unable to modify it from our side. Kindly visit our website, go to ‘Manage My Booking,’ and fill in the required information to make changes. Link: https://shop.flixbus.in/rebooking/login",
+            "We cannot alter your booking after it has been confirmed. Please go to our website, select ‘Manage My Booking,’ and provide the needed details to make any changes. Link: https://shop.flixbus.in/rebooking/login"
+        )
+    },
+    "booking_process": {
+        "keywords": ("how to book", "booking process", "book ticket"),
+        "responses": (
+            "To book a ticket, please visit our website and click on the booking link. Proceed to the checkout page by selecting 'CONTINUE'. Fill out the necessary details: Seat Reservation, Passengers, Contact Information, Payment. Available seat types include Standard free seats, Panorama seats, and Premium seats. Note our gender seating policy ensures female travelers are not seated next to male travelers unless part of the same booking. Carry a valid ID (Aadhar, Passport, or Driving License). Luggage policy allows 7kg hand luggage and 20kg regular luggage free, with additional luggage bookable via Manage My Booking. Payment methods include Credit cards, UPI, and Net Banking. A Rs 5 platform fee applies.",
+        )
+    },
+    "manage_booking_changes": {
+        "keywords": ("change date", "change time", "cancel ticket"),
+        "responses": (
+            "If you wish to change the date or time of your ride, cancel, or postpone it, you can easily make these adjustments through the ‘Manage My Booking’ section. Simply enter your booking number and phone number, click on ‘Retrieve Booking,’ and you will see the options to modify your details. Link: https://shop.flixbus.in/rebooking/login",
+            "If you need to reschedule, cancel, or postpone your ride, you can manage these changes through the ‘Manage My Booking’ portal. Enter your booking number and phone number, then click ‘Retrieve Booking’ to find the options for updating your ride details. Link: https://shop.flixbus.in/rebooking/login"
+        )
+    },
+    "complaint_feedback": {
+        "keywords": ("complain", "feedback", "review"),
+        "responses": (
+            "Thank you so much! We're thrilled to hear that you enjoyed your experience with us. We strive to provide excellent service, and it's always wonderful to receive positive feedback.",
+        )
+    },
+    "rude_behavior": {
+        "keywords": ("rude driver", "rude host", "bad behavior"),
+        "responses": (
+            "I sincerely apologize for the unpleasant experience you had with the driver and the bus host. We deeply regret that their behavior was not up to the standards you expect and deserve. Please be assured that I will escalate this matter to the relevant team for a thorough review and appropriate action. Your feedback is very important to us, and we take such concerns seriously to ensure this doesn’t happen again.",
+        )
+    },
+    "breakdown_refund": {
+        "keywords": ("bus breakdown", "ac not working", "refund breakdown"),
+        "responses": (
+            "Thank you for reaching out, and I sincerely apologize for the inconvenience you've experienced due to the breakdown of the bus. To assist you further and ensure we handle your request appropriately, could you please provide your booking reference number or PNR number, along with the email address or phone number associated with your booking? We are actively working to resolve this and will keep you updated.",
+        )
+    },
+    "route_details": {
+        "keywords": ("route details", "bus route"),
+        "responses": (
+            "I regret to inform you that we don’t have the specific route information about the ride however we have the access for the stop locations associated with your journey with FlixB. These are the stop locations associated with your existing booking. Is there anything else I can help you with?",
+        )
+    },
+    "change_date": {
+        "keywords": ("change date", "reschedule date"),
+        "responses": (
+            "Yes sure, you can change the date of your journey up to 15 minutes before departure time of the bus via manage my booking section on our website. Link: https://shop.flixbus.in/rebooking/login. After clicking on the above link you can see the option for Booking number and Email or Phone number, then you have to fill those required details and click on the retrieve booking. After that you will be able to change the date of your journey. Please note that the prices are dynamic in nature, and any fare difference will be displayed during the rescheduling process.",
+        )
+    },
+    "route_information": {
+        "keywords": ("route information", "bus route info"),
+        "responses": (
+            "I regret to inform you that we don’t have the route information of the ride however we have the access for the stop location associate with that booking. If you have already booked the ticket and want to know the route information of your ride you may click on the link provided below: https://www.flixbus.in/track/",
+        )
+    },
+    "flix_lounge": {
+        "keywords": ("flix lounge", "anand vihar lounge"),
+        "responses": (
+            "Thank you for reaching out to us. We apologize for any confusion, but please note that the Flix Lounge facility is not available at the Anand Vihar location. It serves as an operational point for boarding, and only official work takes place there. We suggest waiting at the boarding point for your bus.",
+        )
+    },
+    "bus_delay_less_120": {
+        "keywords": ("bus delay less than 120", "short delay"),
+        "responses": (
+            "I’m really sorry for the delay of the bus. I understand this can be frustrating, and I sincerely apologize for the inconvenience caused. As checked the bus was delayed due to some operational reasons and traffic issues. I have checked that current status, and while the bus is delayed, it is not delayed by 120 minutes or more from your boarding point. According to our T&C, we can only offer a refund if the bus is delayed by more than 120 minutes from your boarding time. Link: https://www.flixbus.in/terms-and-conditions-of-carriage",
+        )
+    },
+    "bus_delay_over_120": {
+        "keywords": ("bus delay over 120", "long delay"),
+        "responses": (
+            "I sincerely apologize for the delay. I understand how frustrating this can be and I regret the inconvenience caused. Upon investigation, I can confirm that the bus is delayed by more than 2 hours from your boarding point due to operational reasons. If you prefer not to wait, I can proceed with cancelling your ticket and initiate a full refund for you. Would you like me to go ahead with that?",
+        )
+    },
+    "bus_breakdown_ac": {
+        "keywords": ("ac not working", "bus breakdown ac"),
+        "responses": (
+            "I sincerely apologize for the inconvenience caused due to the bus breakdown and as the AC not working. I understand how uncomfortable this must be for you, and I'm truly sorry. To assist you further, could you please share your booking reference number along with the email address or phone number used during the booking? I’ve already highlighted this issue to our team, and they are working on resolving it as soon as possible.",
+        )
+    },
+    "luggage_policy": {
+        "keywords": ("luggage policy", "baggage rules"),
+        "responses": (
+            "Thank you for reaching out regarding our luggage policy. I’m happy to inform you that you are allowed to bring 7kg of hand luggage and 20kg of regular luggage completely free of charge. Additionally, you may bring one extra luggage item of 20kg per passenger. You can book additional luggage via Manage My Booking: https://shop.flixbus.in/rebooking/login. For more details, please visit: https://www.flixbus.in/service/luggage.",
+        )
+    },
+    "cancel_ticket": {
+        "keywords": ("cancel ticket", "ticket cancellation"),
+        "responses": (
+            "I would like to inform you that you may cancel your ticket from your end up to 15 minutes before the departure time of the bus. You can cancel it through our website via Manage My Booking. Link: https://shop.flixbus.in/rebooking/login. After clicking on this link you can see both the option for booking number and email and phone number, then you can fill with the required details and click on the \"Retrieve Booking\" option. Then you will be able to cancel the ticket and choose between a cash refund or a voucher.",
+        )
+    },
+    "stranded_passenger": {
+        "keywords": ("stranded", "left behind"),
+        "responses": (
+            "We’re very sorry to hear about your situation and understand how frustrating this must be. Could you please share your booking reference number, registered email, and phone number so we can look into this for you? Unfortunately, we are unable to offer a refund or arrange an alternative ride in this situation, as per our company policy.",
+        )
+    },
+    "lost_item": {
+        "keywords": ("lost item", "left something", "lost and found"),
+        "responses": (
+            "We’re very sorry to hear that your belongings were left on the bus. We understand how important this is to you. To assist you in recovering your items, may I kindly request you to fill out our Lost and Found form? Our team will investigate the matter and do their best to locate your belongings.",
+        )
+    },
+    "travel_with_pet": {
+        "keywords": ("travel with pet", "pet policy"),
+        "responses": (
+            "Thank you for your inquiry regarding traveling with pets on Flix. Unfortunately, at this time, we are unable to accommodate pets on our buses. This policy is in place to ensure a safe and pleasant experience for everyone on board. For more details, please refer to our official pet policy.",
+        )
+    },
+    "prices_discounts": {
+        "keywords": ("price", "discount", "offer"),
+        "responses": (
+            "The price shown on your ticket is the final price. You do not need to pay any further amount.",
+            "I apologize, but currently, there are no offers or discounts available on our website. However, rest assured that our prices are already set to provide the most convenient options.",
+            "Please note that our prices are dynamically adjusted based on demand, availability, and other factors to ensure the best possible experience for all our passengers. We recommend booking early to secure the best available price."
+        )
+    },
+    "blanket_service": {
+        "keywords": ("blanket", "blanket service"),
+        "responses": (
+            "I regret to inform you but as of now we are not providing Blankets on board however we recommend our customers to carry one along with them for their own comfort and warmth. You may refer to this link you will get to know what kind of services Flix provide.",
+            "We're pleased to inform you that blankets and water bottles have been provided for your convenience on all rides."
+        )
+    },
+    "water_bottle_service": {
+        "keywords": ("water", "water bottle"),
+        "responses": (
+            "We regret to inform you that, as of now, we do not offer water bottle services on our Flix buses. We recommend that passengers bring their own water bottles and any other refreshments they might need for their journey.",
+        )
+    },
+    "washroom_service": {
+        "keywords": ("washroom", "restroom", "toilet"),
+        "responses": (
+            "I regret to inform you that as of now Flix not provided the washroom facilities on the bus. However, the bus host will take care of the comfort breaks while taking your journey.",
+        )
+    },
+    "seat_changes": {
+        "keywords": ("change seat", "seat change"),
+        "responses": (
+            "We apologize, but we are unable to change your seat as it is automatically assigned and based on availability.",
+            "Unfortunately, we cannot change your seat because seats are auto-assigned and system-generated based on current availability."
+        )
+    },
+    "shadow_booking": {
+        "keywords": ("shadow booking", "payment not found", "booking not found"),
+        "responses": (
+            "It's sad to hear about the inconvenience you're experiencing. To assist you further, could you please help me with the following details? 1) Passenger's full name 2) The email ID used for booking 3) The phone number associated with the booking 4) A screenshot of the payment transaction. This information will help us locate your booking and ensure everything is sorted out promptly.",
+            "I apologize for the inconvenience, but I couldn't locate any booking matching the details provided by you.",
+            "I regret to inform you that, I am unable to locate any booking with the provided details."
+        )
+    },
+    "no_refund_statement": {
+        "keywords": ("no refund", "refund denial"),
+        "responses": (
+            "After thoroughly investigating the incident, we found that the bus arrived at the designated boarding point and other passengers successfully boarded the bus. Unfortunately, due to these circumstances, we are unable to process a refund for your ticket.",
+        )
+    },
+    "refund_processing": {
+        "keywords": ("refund status", "refund processing"),
+        "responses": (
+            "Your ticket has been cancelled as of (DATE). Please note that it will take up to 7 working days for the amount of (AMOUNT) to be credited back to your account. Don’t worry, your funds are secure and will be refunded within the maximum time frame.",
+            "We would like to inform you that your ticket has been cancelled on (DATE). The refund amount of (AMOUNT) will be processed and should appear in your account within 7 working days. Please be assured that your money is safe and will be returned within this period."
+        )
+    },
+    "refund_tat_crossed": {
+        "keywords": ("refund not received", "late refund"),
+        "responses": (
+            "We would like to inform you that the refund has been initiated from our end on [DATE] for the amount of [XXXX]. Please check with your bank regarding the status of this refund. If you do not receive the amount, kindly share your bank statement up to the current date for further assistance.",
+        )
+    },
+    "closing_statement": {
+        "keywords": ("goodbye", "bye", "thanks", "done"),
+        "responses": (
+            "Thank you for contacting Flix. Have a great day!",
+            "I’m happy to have assisted you with your inquiry! If you have any other questions or need further assistance, please feel free to reach out. Have a wonderful day!",
+            "It was a pleasure assisting you today. If you need further assistance or have any more questions, don't hesitate to contact us again. Have a wonderful day!"
+        )
+    },
+    "request_feedback": {
+        "keywords": ("feedback", "rate conversation", "survey"),
+        "responses": (
+            "Looking forward for your valuable feedback towards my response, the link or the option will be there right after the chat ends.",
+            "We appreciate your feedback and look forward to hearing from you. You’ll find the link or option available once our chat concludes.",
+            "Your feedback towards my response is important for me! The link or option will be provided immediately after our conversation ends."
+        )
+    }
+})
+
 class CustomAI:
     """Optimized AI for fast query response."""
     
     def __init__(self):
-        self.vectorizer = TfidfVectorizer(max_features=100, stop_words='english')
+        self.vectorizer = HashedTfidfVectorizer(max_features=100)
         self.training_data = {
             "queries": [],
-            "cluster_labels": [],
             "generated_responses": {},
             "learned_phrases": {},
             "used_responses": {},
             "intent_mappings": {}
         }
         self.data_file = os.getenv("DATA_FILE", "/tmp/training_data.json")
+        self.log_file = os.getenv("TRAINING_LOG_FILE", os.path.splitext(self.data_file)[0] + ".jsonl")
+        self.model_file = os.getenv("MODEL_FILE", os.path.splitext(self.data_file)[0] + ".joblib")
+        self.pending_delta = []  # Records not yet flushed to the training log
+        # Tags log records, so the trainer skips its own when tailing the log; unlike a pid, never reused by a restart
+        self.worker_id = uuid.uuid4().hex
+        self._log_offset = 0  # Bytes of the training log already applied
+        self.flushed_phrase_count = 0
+        self._retry_phrases = {}  # Learned phrases from a failed log write, flushed with the next delta
         self.query_count = 0
+        self._lock = threading.RLock()  # Guards training data and model state shared with the retrain thread
+        self.retrain_due = False
+        self._queries_since_retrain = 0  # Own and other workers' queries recorded since the last retrain
+        self._retrain_pending = False  # A retrain is queued and has not started yet
+        self.persist_due = False
+        self._rng = random.Random()  # Scalar draws on the request path
+        self._np_rng = np.random.default_rng()  # Vectorized draws for clustering
         self.train_interval = 20  # Increased to reduce clustering frequency
+        self.full_retrain_interval = 1000  # Queries between full refits; retrains in between update clusters online
+        self.stable_vocabulary_overlap = 0.95  # A full retrain keeps the fitted vectorizer above this vocabulary overlap
+        self._full_retrain_at = -self.full_retrain_interval  # query_count at the last full refit; the first retrain is full
+        self.max_history = int(os.getenv("MAX_HISTORY", 10000))  # Oldest queries beyond this are evicted FIFO
+        self._history_trimmed = False  # History was cut on load, so stored cluster labels no longer line up
+        self._shared_view = False  # Reader serving the trainer's mapped corpus; the trainer tails its logged queries
         self.save_interval = 10  # Save data every 10 queries
         self.used_response_sets = defaultdict(set)
+        new_response_templates = [
+            "For {query}, {action}",
+            "Regarding {query}, {action}",
+            "About {query}, {action}"
+        ]
+        new_response_actions = [
+            "please check our website for more details",
+            "visit our support page for assistance",
+            "contact our team for further assistance",
+            "refer to our FAQ for quick answers"
+        ]
+        # Every template/action combination, pre-split around {query}
+        self.new_response_parts = tuple(
+            (prefix, suffix.replace("{action}", action))
+            for prefix, _, suffix in (t.partition("{query}") for t in new_response_templates)
+            for action in new_response_actions
+        )
         self.num_clusters = 5  # Reduced for faster clustering
+        self.minibatch_min_samples = 1000  # Below this, plain Lloyd's iterations beat MiniBatchKMeans setup cost
         self.vectorizer_fitted = False  # Track vectorizer state
+        self._query_counts = None  # Hashed term counts of the query history, extended by each fit
+        self._centroids = None  # L2-normalized float32 centroids from the last clustering
+        self._category_vectors = None  # L2-normalized float32 TF-IDF vector per category
+        self._corpus_dense = None  # Float32 TF-IDF rows of the query history, grown in place
+        self._corpus_size = 0
+        self._query_scratch = None  # Reused (1, V) float32 buffer for densifying query rows
+        self._clustered_labels = np.empty(0, dtype=np.int32)  # Labels from the last clustering; later queries are -1
+        self._cluster_counts = np.zeros(self.num_clusters, dtype=np.int64)  # Members per cluster, for online updates
+        self._query_categories = []  # Keyword category of each stored query, resolved once on append
         self.personalized_ai = PersonalizedAI()
-        self.query_response_map = self.load_response_map()
-        self.load_training_data()
-
-    def load_response_map(self):
-        """Load predefined responses for specific query categories."""
-        return {
-            "greeting": {
-                "keywords": ["hello", "hi", "greetings", "welcome"],
-                "responses": [
-                    "Hello and welcome to Flix! I'm here to assist you. How may I help you today?",
-                    "Greetings and welcome to Flix. How may I assist you?",
-                    "Welcome to Flix! My name is your assistant. How can I help you?",
-                    "Hi, Welcome to Flix, I am your assistant. How may I assist you?"
-                ]
-            },
-            "appreciation": {
-                "keywords": ["thank you", "reaching out", "contacted", "reporting"],
-                "responses": [
-                    "I appreciate that you have reached out to us with your query.",
-                    "Thank you for reaching out with your inquiry.",
-                    "I am grateful that you contacted us regarding your concern.",
-                    "I appreciate that you are reporting to us about this concern. I will look into it immediately."
-                ]
-            },
-            "verification_details": {
-                "keywords": ["booking number", "pnr", "passenger name", "verify"],
-                "responses": [
-                    "Sure, I'm here to help. To assist you effectively, please provide the following details: Booking number or PNR Number, Passenger's full name, Booking email address or booking phone number. Once you share this information, I'll be able to assist you promptly.",
-                    "Certainly, I'm ready to assist you. To ensure I can help you effectively, please provide the following details: Booking number, Passenger's full name, Booking email address or booking phone number. Once you provide these details, I'll be able to assist you accordingly."
-                ]
-            },
-            "processing_time": {
-                "keywords": ["checking", "moment", "please wait"],
-                "responses": [
-                    "Thank you for sharing the details. Please allow me a moment to look for your concern.",
-                    "Thank you for providing the information. Please allow me a moment to check with the details.",
-                    "Thank you for sharing these details. Just a moment, please, I'm checking on the same."
-                ]
-            },
-            "extended_processing": {
-                "keywords": ["still checking", "more time"],
-                "responses": [
-                    "I am still checking your booking/ride details. Please be with me.",
-                    "I got booking however need to check the issue with your ride."
-                ]
-            },
-            "patience_appreciation": {
-                "keywords": ["patience", "thank you for waiting"],
-                "responses": [
-                    "Thank you so much for your patience.",
-                    "I really appreciate your patience.",
-                    "Thank you so much for notifying me about the issue.",
-                    "Thank you for reaching out to me about this.",
-                    "I will get your issue resolved positively.",
-                    "I appreciate your patience in this matter.",
-                    "Your patience is appreciable."
-                ]
-            },
-            "board_from_other_location": {
-                "keywords": ["board from other", "change boarding", "different location"],
-                "responses": [
-                    "May I know why you want to change the boarding point and make it to other? As per the T&C, your ticket is valid for the boarding location to booked for and I regret to inform that boarding from other location isn't possible. Link: https://help.flixbus.com/s/article/PSSPCan-I-board-the-bus-at-a-later-stop?language=en_IN",
-                    "I understand your preference for boarding the bus from your desired location. However, to ensure a smooth process, we kindly ask you to board from the designated location where the QR code can be scanned by the bus staff. Link: https://help.flixbus.com/s/article/PSSPCan-I-board-the-bus-at-a-later-stop?language=en_IN",
-                    "While I appreciate your desire to board the bus from a different location, please note that the process requires the QR code to be scanned by the host at the specified boarding point. We recommend using the designated location for a seamless experience. Link: https://help.flixbus.com/s/article/PSSPCan-I-board-the-bus-at-a-later-stop?language=en_IN",
-                    "I understand your request to board the bus from your chosen location. Unfortunately, due to our procedures, the QR code must be scanned by the host at the specified point. We encourage you to use the designated boarding location for a smooth transition. Link: https://help.flixbus.com/s/article/PSSPCan-I-board-the-bus-at-a-later-stop?language=en_IN",
-                    "Thank you for your understanding. Although we recognize your preferred boarding location, our process mandates that the QR code be scanned by the host at the assigned area. For a hassle-free experience, please board from the designated location. Link: https://help.flixbus.com/s/article/PSSPCan-I-board-the-bus-at-a-later-stop?language=en_IN"
-                ]
-            },
-            "boarding_point_details": {
-                "keywords": ["boarding point", "where to board"],
-                "responses": [
-                    "The ticket contains essential details such as the boarding points, bus route number, a link in the bottom right corner, and a GPS link that can be accessed by clicking on the boarding point for more information.",
-                    "You can find important information on the ticket, including boarding points, the bus route number, a link at the bottom right corner, and a GPS link accessible by clicking on the boarding point.",
-                    "The ticket provides various details, such as the boarding points, the bus route number, a link located in the bottom right corner, and a GPS link available by clicking on the boarding point for further information."
-                ]
-            },
-            "price_difference": {
-                "keywords": ["price difference", "why price change", "fare change"],
-                "responses": [
-                    "I would like to inform you that as the prices are dynamic in nature and may change on the website with time.",
-                    "Please note that our prices are dynamically adjusted based on demand, availability, and other factors to ensure the best possible experience for all our passengers.",
-                    "To provide you with the most accurate and fair pricing, our rates are dynamically updated. We recommend booking early to secure the best available price.",
-                    "We always recommend our passengers about a price lock feature where the price shown at the time of selection is reserved for 10 minutes, allowing passengers to complete their booking at the same rate within this timeframe. Delays in booking beyond this period may result in price adjustments.",
-                    "We suggest booking early and utilizing the price lock feature to secure the most favorable fare."
-                ]
-            },
-            "pre_departure_call": {
-                "keywords": ["pre departure call", "call before departure"],
-                "responses": [
-                    "I completely understand that you are expecting a call from the bus staff. Please note that pre-departure calls are not mandatory however, the host might call you before arriving at your departure point. We appreciate your understanding."
-                ]
-            },
-            "bus_delay": {
-                "keywords": ["bus late", "bus delay", "delayed bus"],
-                "responses": [
-                    "I regret to inform you that the bus is running late due to some operational reason and apologize for the inconvenience caused due to delay. So requesting you to please be available on the boarding point as the ride has already been departed from the previous boarding point and now going to reach your boarding point as quickly as possible. I appreciate your understanding.",
-                    "I’m sincerely apologizing for the delay of the ride and sorry for the inconvenience caused to you. I would like to inform you that due to some operational reason the ride has been delayed and our operational team is trying to manage the delay and reach out your boarding point as soon as possible.",
-                    "I regret to inform you that due to the heavy traffic the ride got stuck and now it’s get back on the track and the operational team is trying to manage that delay and reach out to your boarding point as quickly as possible. We need your patience and understanding in this matter."
-                ]
-            },
-            "missed_bus": {
-                "keywords": ["missed bus", "miss bus", "left behind"],
-                "responses": [
-                    "We see you as a valued customer and do not wish to leave you behind. However, it’s necessary to move the bus on schedule, as we have a commitment to punctuality. I sincerely apologize for the inconvenience caused by missing the bus.",
-                    "We appreciate you as a valued customer and have no intention of leaving you behind. At the same time, we must adhere to the bus's scheduled departure time for the sake of punctuality. I understand how frustrating this can be, and I’m here to help you any further assistance you may need.",
-                    "We truly value you as a customer, and it’s not in our interest to leave you behind. However, we also have to ensure the bus departs on time, as punctuality is essential. Please help me with the booking reference number or the PNR number for verification process so that I can help you with the information associated with your journey with Flix."
-                ]
-            },
-            "bus_host_number": {
-                "keywords": ["bus number", "host number", "driver number"],
-                "responses": [
-                    "I really apologize that I am unable to provide the bus number however you may identify your ride through the route number mentioned on the ticket and it gets displayed in front of the bus as well.",
-                    "I regret to inform you that we don't have access to the bus driver or host's contact information. So, we always request our passengers to be at the pickup point 15 minutes prior to the departure, You may track your ride through the tracing link mentioned on the ticket."
-                ]
-            },
-            "where_is_bus": {
-                "keywords": ["where is bus", "bus location", "track bus"],
-                "responses": [
-                    "As checked, the ride is for your booked route. So, I would like to inform you that the ride will arrive at the boarding point as per the mentioned time on the ticket. I’m requesting you to please be present at the boarding point 15 minutes before the departure time of the bus, so that you can easily board the bus. Here I’m sharing the bus route number which is mentioned on the ticket just under the boarding point details and it’s also available in front of the bus from which you can easily recognize your bus. Tracking Link: https://global.flixbus.com/track/order/3242800682",
-                    "I’m requesting you to please be available on the boarding point 15 minutes before the departure time of the bus, so that you can easily board the bus. Have a safe and pleasant journey ahead with Flix. Tracking Link: https://global.flixbus.com/track/order/3242800682"
-                ]
-            },
-            "where_is_boarding_point": {
-                "keywords": ["boarding point location", "where is boarding point"],
-                "responses": [
-                    "As checked the ticket is for your booked route. This is the address of your boarding point. This is the Google map link for the exact boarding point location. I’m requesting you to please be available on the boarding point 15 minutes before the departure time of the bus, so that you can easily board the bus. Have a safe and pleasant journey ahead with Flix."
-                ]
-            },
-            "pax_running_late": {
-                "keywords": ["running late", "late to board", "wait for me"],
-                "responses": [
-                    "Extremely sorry to inform you that the bus will depart from the boarding point as per the scheduled time so requesting you to please try to reach the boarding point before the mentioned time on the ticket and ensure not to miss the bus.",
-                    "Unfortunately, the bus cannot wait for the delayed passengers. Our buses travel within a network and are bound to follow a timetable. Please ensure that you are at the stop at least 15 minutes before departure. If you realize that you’re not going to reach in time, you can cancel your ride up to 15 minutes before departure via manage my booking of our website. Link: https://shop.flixbus.in/rebooking/login"
-                ]
-            },
-            "ride_cancellation": {
-                "keywords": ["ride cancelled", "bus cancelled", "cancellation"],
-                "responses": [
-                    "I’m really sorry for the inconvenience caused to you due to the ride cancellation and I would like to inform you that due to some operational reason the ride has been cancelled and after cancellation a self-help link has been provided to you via email with the booking email id. So requesting you to please check the email inbox along with the spam folder for the same and after clicking on that link you will be able to book an alternative ride completely free of cost for any other day you want or you may cancel the trip and generate a full ticket refund for yourself which will be credited to the source account within 7 working days.",
-                    "I’m really sorry for the inconvenience caused to you due to the ride cancellation. Or if you want I can help you with the full ticket refund by cancelling the ticket from our end and the refund will be credited to the source account within 7 working days excluding Saturday, Sunday and Public holidays/ Bank holidays. With your permission should I proceed with the refund?"
-                ]
-            },
-            "no_show_refund_denial": {
-                "keywords": ["no show", "missed bus refund", "didn't board"],
-                "responses": [
-                    "I deeply apologize for the inconvenience you're experiencing, and I understand your frustration. I'm unable to proceed with either the refund or booking an alternative ride for you at this time. As per our company policy, in such cases where the service has been provided as intended, we are unable to process a refund. Link: https://www.flixbus.in/terms-and-conditions-of-carriage, clause number 12.2.5",
-                    "After thoroughly investigating the incident, we confirmed that the bus arrived at the designated boarding point, other passengers boarded successfully, and the bus departed after the scheduled time. Regrettably, under these circumstances, we are unable to issue a refund for your ticket. Link: https://www.flixbus.in/terms-and-conditions-of-carriage, clause number 12.2.5"
-                ]
-            },
-            "booking_changes_denial": {
-                "keywords": ["change booking", "modify booking"],
-                "responses": [
-                    "Once your ticket is booked, we are unable to modify it from our side. Kindly visit our website, go to ‘Manage My Booking,’ and fill in the required information to make changes. Link: https://shop.flixbus.in/rebooking/login",
-                    "We cannot alter your booking after it has been confirmed. Please go to our website, select ‘Manage My Booking,’ and provide the needed details to make any changes. Link: https://shop.flixbus.in/rebooking/login"
-                ]
-            },
-            "booking_process": {
-                "keywords": ["how to book", "booking process", "book ticket"],
-                "responses": [
-                    "To book a ticket, please visit our website and click on the booking link. Proceed to the checkout page by selecting 'CONTINUE'. Fill out the necessary details: Seat Reservation, Passengers, Contact Information, Payment. Available seat types include Standard free seats, Panorama seats, and Premium seats. Note our gender seating policy ensures female travelers are not seated next to male travelers unless part of the same booking. Carry a valid ID (Aadhar, Passport, or Driving License). Luggage policy allows 7kg hand luggage and 20kg regular luggage free, with additional luggage bookable via Manage My Booking. Payment methods include Credit cards, UPI, and Net Banking. A Rs 5 platform fee applies."
-                ]
-            },
-            "manage_booking_changes": {
-                "keywords": ["change date", "change time", "cancel ticket"],
-                "responses": [
-                    "If you wish to change the date or time of your ride, cancel, or postpone it, you can easily make these adjustments through the ‘Manage My Booking’ section. Simply enter your booking number and phone number, click on ‘Retrieve Booking,’ and you will see the options to modify your details. Link: https://shop.flixbus.in/rebooking/login",
-                    "If you need to reschedule, cancel, or postpone your ride, you can manage these changes through the ‘Manage My Booking’ portal. Enter your booking number and phone number, then click ‘Retrieve Booking’ to find the options for updating your ride details. Link: https://shop.flixbus.in/rebooking/login"
-                ]
-            },
-            "complaint_feedback": {
-                "keywords": ["complain", "feedback", "review"],
-                "responses": [
-                    "Thank you so much! We're thrilled to hear that you enjoyed your experience with us. We strive to provide excellent service, and it's always wonderful to receive positive feedback."
-                ]
-            },
-            "rude_behavior": {
-                "keywords": ["rude driver", "rude host", "bad behavior"],
-                "responses": [
-                    "I sincerely apologize for the unpleasant experience you had with the driver and the bus host. We deeply regret that their behavior was not up to the standards you expect and deserve. Please be assured that I will escalate this matter to the relevant team for a thorough review and appropriate action. Your feedback is very important to us, and we take such concerns seriously to ensure this doesn’t happen again."
-                ]
-            },
-            "breakdown_refund": {
-                "keywords": ["bus breakdown", "ac not working", "refund breakdown"],
-                "responses": [
-                    "Thank you for reaching out, and I sincerely apologize for the inconvenience you've experienced due to the breakdown of the bus. To assist you further and ensure we handle your request appropriately, could you please provide your booking reference number or PNR number, along with the email address or phone number associated with your booking? We are actively working to resolve this and will keep you updated."
-                ]
-            },
-            "route_details": {
-                "keywords": ["route details", "bus route"],
-                "responses": [
-                    "I regret to inform you that we don’t have the specific route information about the ride however we have the access for the stop locations associated with your journey with FlixB. These are the stop locations associated with your existing booking. Is there anything else I can help you with?"
-                ]
-            },
-            "change_date": {
-                "keywords": ["change date", "reschedule date"],
-                "responses": [
-                    "Yes sure, you can change the date of your journey up to 15 minutes before departure time of the bus via manage my booking section on our website. Link: https://shop.flixbus.in/rebooking/login. After clicking on the above link you can see the option for Booking number and Email or Phone number, then you have to fill those required details and click on the retrieve booking. After that you will be able to change the date of your journey. Please note that the prices are dynamic in nature, and any fare difference will be displayed during the rescheduling process."
-                ]
-            },
-            "route_information": {
-                "keywords": ["route information", "bus route info"],
-                "responses": [
-                    "I regret to inform you that we don’t have the route information of the ride however we have the access for the stop location associate with that booking. If you have already booked the ticket and want to know the route information of your ride you may click on the link provided below: https://www.flixbus.in/track/"
-                ]
-            },
-            "flix_lounge": {
-                "keywords": ["flix lounge", "anand vihar lounge"],
-                "responses": [
-                    "Thank you for reaching out to us. We apologize for any confusion, but please note that the Flix Lounge facility is not available at the Anand Vihar location. It serves as an operational point for boarding, and only official work takes place there. We suggest waiting at the boarding point for your bus."
-                ]
-            },
-            "bus_delay_less_120": {
-                "keywords": ["bus delay less than 120", "short delay"],
-                "responses": [
-                    "I’m really sorry for the delay of the bus. I understand this can be frustrating, and I sincerely apologize for the inconvenience caused. As checked the bus was delayed due to some operational reasons and traffic issues. I have checked that current status, and while the bus is delayed, it is not delayed by 120 minutes or more from your boarding point. According to our T&C, we can only offer a refund if the bus is delayed by more than 120 minutes from your boarding time. Link: https://www.flixbus.in/terms-and-conditions-of-carriage"
-                ]
-            },
-            "bus_delay_over_120": {
-                "keywords": ["bus delay over 120", "long delay"],
-                "responses": [
-                    "I sincerely apologize for the delay. I understand how frustrating this can be and I regret the inconvenience caused. Upon investigation, I can confirm that the bus is delayed by more than 2 hours from your boarding point due to operational reasons. If you prefer not to wait, I can proceed with cancelling your ticket and initiate a full refund for you. Would you like me to go ahead with that?"
-                ]
-            },
-            "bus_breakdown_ac": {
-                "keywords": ["ac not working", "bus breakdown ac"],
-                "responses": [
-                    "I sincerely apologize for the inconvenience caused due to the bus breakdown and as the AC not working. I understand how uncomfortable this must be for you, and I'm truly sorry. To assist you further, could you please share your booking reference number along with the email address or phone number used during the booking? I’ve already highlighted this issue to our team, and they are working on resolving it as soon as possible."
-                ]
-            },
-            "luggage_policy": {
-                "keywords": ["luggage policy", "baggage rules"],
-                "responses": [
-                    "Thank you for reaching out regarding our luggage policy. I’m happy to inform you that you are allowed to bring 7kg of hand luggage and 20kg of regular luggage completely free of charge. Additionally, you may bring one extra luggage item of 20kg per passenger. You can book additional luggage via Manage My Booking: https://shop.flixbus.in/rebooking/login. For more details, please visit: https://www.flixbus.in/service/luggage."
-                ]
-            },
-            "cancel_ticket": {
-                "keywords": ["cancel ticket", "ticket cancellation"],
-                "responses": [
-                    "I would like to inform you that you may cancel your ticket from your end up to 15 minutes before the departure time of the bus. You can cancel it through our website via Manage My Booking. Link: https://shop.flixbus.in/rebooking/login. After clicking on this link you can see both the option for booking number and email and phone number, then you can fill with the required details and click on the \"Retrieve Booking\" option. Then you will be able to cancel the ticket and choose between a cash refund or a voucher."
-                ]
-            },
-            "stranded_passenger": {
-                "keywords": ["stranded", "left behind"],
-                "responses": [
-                    "We’re very sorry to hear about your situation and understand how frustrating this must be. Could you please share your booking reference number, registered email, and phone number so we can look into this for you? Unfortunately, we are unable to offer a refund or arrange an alternative ride in this situation, as per our company policy."
-                ]
-            },
-            "lost_item": {
-                "keywords": ["lost item", "left something", "lost and found"],
-                "responses": [
-                    "We’re very sorry to hear that your belongings were left on the bus. We understand how important this is to you. To assist you in recovering your items, may I kindly request you to fill out our Lost and Found form? Our team will investigate the matter and do their best to locate your belongings."
-                ]
-            },
-            "travel_with_pet": {
-                "keywords": ["travel with pet", "pet policy"],
-                "responses": [
-                    "Thank you for your inquiry regarding traveling with pets on Flix. Unfortunately, at this time, we are unable to accommodate pets on our buses. This policy is in place to ensure a safe and pleasant experience for everyone on board. For more details, please refer to our official pet policy."
-                ]
-            },
-            "prices_discounts": {
-                "keywords": ["price", "discount", "offer"],
-                "responses": [
-                    "The price shown on your ticket is the final price. You do not need to pay any further amount.",
-                    "I apologize, but currently, there are no offers or discounts available on our website. However, rest assured that our prices are already set to provide the most convenient options.",
-                    "Please note that our prices are dynamically adjusted based on demand, availability, and other factors to ensure the best possible experience for all our passengers. We recommend booking early to secure the best available price."
-                ]
-            },
-            "blanket_service": {
-                "keywords": ["blanket", "blanket service"],
-                "responses": [
-                    "I regret to inform you but as of now we are not providing Blankets on board however we recommend our customers to carry one along with them for their own comfort and warmth. You may refer to this link you will get to know what kind of services Flix provide.",
-                    "We're pleased to inform you that blankets and water bottles have been provided for your convenience on all rides."
-                ]
-            },
-            "water_bottle_service": {
-                "keywords": ["water", "water bottle"],
-                "responses": [
-                    "We regret to inform you that, as of now, we do not offer water bottle services on our Flix buses. We recommend that passengers bring their own water bottles and any other refreshments they might need for their journey."
-                ]
-            },
-            "washroom_service": {
-                "keywords": ["washroom", "restroom", "toilet"],
-                "responses": [
-                    "I regret to inform you that as of now Flix not provided the washroom facilities on the bus. However, the bus host will take care of the comfort breaks while taking your journey."
-                ]
-            },
-            "seat_changes": {
-                "keywords": ["change seat", "seat change"],
-                "responses": [
-                    "We apologize, but we are unable to change your seat as it is automatically assigned and based on availability.",
-                    "Unfortunately, we cannot change your seat because seats are auto-assigned and system-generated based on current availability."
-                ]
-            },
-            "shadow_booking": {
-                "keywords": ["shadow booking", "payment not found", "booking not found"],
-                "responses": [
-                    "It's sad to hear about the inconvenience you're experiencing. To assist you further, could you please help me with the following details? 1) Passenger's full name 2) The email ID used for booking 3) The phone number associated with the booking 4) A screenshot of the payment transaction. This information will help us locate your booking and ensure everything is sorted out promptly.",
-                    "I apologize for the inconvenience, but I couldn't locate any booking matching the details provided by you.",
-                    "I regret to inform you that, I am unable to locate any booking with the provided details."
-                ]
-            },
-            "no_refund_statement": {
-                "keywords": ["no refund", "refund denial"],
-                "responses": [
-                    "After thoroughly investigating the incident, we found that the bus arrived at the designated boarding point and other passengers successfully boarded the bus. Unfortunately, due to these circumstances, we are unable to process a refund for your ticket."
-                ]
-            },
-            "refund_processing": {
-                "keywords": ["refund status", "refund processing"],
-                "responses": [
-                    "Your ticket has been cancelled as of (DATE). Please note that it will take up to 7 working days for the amount of (AMOUNT) to be credited back to your account. Don’t worry, your funds are secure and will be refunded within the maximum time frame.",
-                    "We would like to inform you that your ticket has been cancelled on (DATE). The refund amount of (AMOUNT) will be processed and should appear in your account within 7 working days. Please be assured that your money is safe and will be returned within this period."
-                ]
-            },
-            "refund_tat_crossed": {
-                "keywords": ["refund not received", "late refund"],
-                "responses": [
-                    "We would like to inform you that the refund has been initiated from our end on [DATE] for the amount of [XXXX]. Please check with your bank regarding the status of this refund. If you do not receive the amount, kindly share your bank statement up to the current date for further assistance."
-                ]
-            },
-            "closing_statement": {
-                "keywords": ["goodbye", "bye", "thanks", "done"],
-                "responses": [
-                    "Thank you for contacting Flix. Have a great day!",
-                    "I’m happy to have assisted you with your inquiry! If you have any other questions or need further assistance, please feel free to reach out. Have a wonderful day!",
-                    "It was a pleasure assisting you today. If you need further assistance or have any more questions, don't hesitate to contact us again. Have a wonderful day!"
-                ]
-            },
-            "request_feedback": {
-                "keywords": ["feedback", "rate conversation", "survey"],
-                "responses": [
-                    "Looking forward for your valuable feedback towards my response, the link or the option will be there right after the chat ends.",
-                    "We appreciate your feedback and look forward to hearing from you. You’ll find the link or option available once our chat concludes.",
-                    "Your feedback towards my response is important for me! The link or option will be provided immediately after our conversation ends."
-                ]
-            }
+        self.query_response_map = _QUERY_RESPONSE_MAP
+        # Flat (keywords, responses) view keyed by interned category names for the request path
+        self._response_table = {
+            sys.intern(category): (info["keywords"], info["responses"])
+            for category, info in self.query_response_map.items()
         }
+        self._category_names = list(self._response_table)
+        # Keyword documents never change, so hash them once and only reweight on refit
+        self._category_counts = self.vectorizer.count(
+            [" ".join(self._response_table[category][0]) for category in self._category_names]
+        )
+        self.category_hits = Counter()  # Per-category hit counts used to order the classifier
+        self.build_classifier()
+        self.build_query_transform()
+        self.model_mtime = None
+        self.is_trainer = self.acquire_trainer_lock()
+        self.training_log = AppendLog(self.log_file)  # Opened first: its shared lock covers the replay
+        self.load_training_data()
+        self.load_model_state()
 
     def load_training_data(self):
         """Load training data with robust error handling."""
         try:
             if not os.path.exists(self.data_file):
                 logger.info(f"Initializing empty training data file at {self.data_file}")
-                with open(self.data_file, 'w', encoding='utf-8') as f:
-                    json.dump(self.training_data, f, indent=4)
-                return
-            with open(self.data_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+                with open(self.data_file, 'wb') as f:
+                    f.write(orjson.dumps(self.training_data, default=list))
+            else:
+                with open(self.data_file, 'rb') as f:
+                    data = orjson.loads(f.read())
                 if isinstance(data, dict) and "queries" in data:
+                    data.pop("cluster_labels", None)  # Older snapshots; labels now persist only in the model state
+                    self._log_offset = data.pop("log_offset", 0)
                     self.training_data.update(data)
+                    self.training_data["used_responses"] = {
+                        category: set(responses) for category, responses in self.training_data["used_responses"].items()
+                    }
                     self.personalized_ai.learned_phrases = self.training_data["learned_phrases"]
                     logger.info(f"Loaded training data from {self.data_file}")
                 else:
                     logger.warning(f"Invalid data format in {self.data_file}, resetting to empty")
                     self.save_training_data()
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logger.error(f"JSON parse error in {self.data_file}: {str(e)}, resetting to empty")
             self.save_training_data()
         except Exception as e:
             logger.error(f"Error loading training data: {str(e)}, resetting to empty")
             self.save_training_data()
+        # Repeated queries share one string object
+        self.training_data["queries"] = [sys.intern(query) for query in self.training_data["queries"]]
+        self.recategorize_queries()
+        replayed = self.tail_training_log()
+        self.flushed_phrase_count = len(self.personalized_ai.learned_phrases)
+        excess = len(self.training_data["queries"]) - self.max_history
+        if excess > 0:
+            self.evict_history(excess)
+            self._history_trimmed = True
+        if replayed is not None and (replayed or excess > 0) and self.is_trainer:
+            self.compact_training_log()
+
+    def tail_training_log(self):
+        """Apply training log records appended since the last read; returns the record count, None on error."""
+        try:
+            with open(self.log_file, 'rb') as f:
+                if self._log_offset > os.fstat(f.fileno()).st_size:
+                    self._log_offset = 0  # The log was replaced underneath the stored offset
+                f.seek(self._log_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            logger.error(f"Error reading training log: {str(e)}")
+            return None
+        end = data.rfind(b"\n") + 1  # A trailing partial line is still being written
+        applied = 0
+        with self._lock:
+            for line in data[:end].splitlines():
+                if not line:
+                    continue
+                try:
+                    record = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    logger.warning(f"Skipping corrupt record in {self.log_file}")
+                    continue
+                if record.get("worker") == self.worker_id:
+                    continue  # Already applied when this worker recorded it
+                if "learned_phrases" in record:
+                    self.personalized_ai.learned_phrases.update(record["learned_phrases"])
+                else:
+                    self.apply_delta(record)
+                    if self._corpus_dense is not None and not self._shared_view:
+                        self.append_corpus_row(record["query"])
+                applied += 1
+            self._log_offset += end
+        return applied
+
+    def compact_training_log(self):
+        """Fold the applied training log into the snapshot, emptying the log only if no other worker has it open."""
+        if not self.training_log.try_lock_exclusive():
+            # Other workers are appending: record how far the snapshot covers instead of truncating
+            if self.save_training_data():
+                logger.info(f"Snapshotted training data up to log offset {self._log_offset}")
+            return
+        try:
+            self.tail_training_log()  # Records appended before the other writers went away
+            # Save, empty the log, then save again: a crash in between replays from the saved offset
+            if self.save_training_data() and self.tail_training_log() == 0:
+                self.training_log.truncate()
+                self._log_offset = 0
+                self.save_training_data()
+                logger.info(f"Compacted the training log into {self.data_file}")
+        finally:
+            self.training_log.unlock_exclusive()
+
+    def evict_history(self, excess):
+        """Drop the oldest queries and everything indexed by their position."""
+        del self.training_data["queries"][:excess]
+        if self._shared_view:
+            return  # Positions index the trainer's view, which it evicts itself
+        del self._query_categories[:excess]
+        if self._corpus_dense is not None:
+            drop = min(excess, self._corpus_size)
+            self._corpus_dense = self._corpus_dense[drop:]  # A view; the next capacity doubling copies it out
+            self._corpus_size -= drop
+        self.set_cluster_labels(self._clustered_labels[excess:])
+        if self._query_counts is not None:
+            self._query_counts = self._query_counts[excess:] if excess < self._query_counts.shape[0] else None
+        logger.info(f"Evicted {excess} oldest queries, keeping {len(self.training_data['queries'])}")
 
     def save_training_data(self):
-        """Save training data with batching."""
+        """Save a full training data snapshot."""
+        if not self.is_trainer:
+            return False
         self.training_data["learned_phrases"] = self.personalized_ai.learned_phrases
+        tmp_file = self.data_file + ".tmp"
         try:
-            with open(self.data_file, 'w', encoding='utf-8') as f:
-                json.dump(self.training_data, f, indent=4)
+            # Write aside and rename, so a crash mid-save never leaves a truncated snapshot
+            with open(tmp_file, 'wb') as f:
+                f.write(orjson.dumps(dict(self.training_data, log_offset=self._log_offset), default=list))
+            os.replace(tmp_file, self.data_file)
             logger.debug(f"Saved training data to {self.data_file}")
+            return True
         except Exception as e:
             logger.error(f"Error saving training data: {str(e)}")
+            return False
+
+    def apply_delta(self, record):
+        """Apply a single training record to the in-memory training data."""
+        query = sys.intern(record["query"])
+        self.training_data["queries"].append(query)
+        query_lower = sys.intern(query.lower())
+        if not self._shared_view:
+            self._query_categories.append(self.match_category(query_lower))
+        if record.get("intent"):
+            self.training_data["intent_mappings"][query_lower] = record["intent"]
+        if record.get("response") and record.get("category"):
+            category = record["category"]
+            self.training_data["generated_responses"].setdefault(category, []).append(record["response"])
+            self.training_data["used_responses"].setdefault(category, set()).add(record["response"])
+
+    def take_delta(self):
+        """Detach pending training records and newly learned phrases for flushing."""
+        with self._lock:
+            records, self.pending_delta = self.pending_delta, []
+            new_phrases, self._retry_phrases = self._retry_phrases or None, {}
+        learned_phrases = self.personalized_ai.learned_phrases
+        if len(learned_phrases) > self.flushed_phrase_count:
+            new_phrases = dict(new_phrases or {}, **dict(islice(learned_phrases.items(), self.flushed_phrase_count, None)))
+            self.flushed_phrase_count = len(learned_phrases)
+        return records, new_phrases
+
+    def write_delta(self, records, new_phrases):
+        """Serialize a detached delta as JSONL and append it to the training log."""
+        lines = [orjson.dumps(record) for record in records]
+        if new_phrases:
+            lines.append(orjson.dumps({"learned_phrases": new_phrases, "worker": self.worker_id}))
+        if not lines:
+            return
+        try:
+            self._flush_delta(b"\n".join(lines) + b"\n")
+        except Exception as e:
+            # Put back what did not land, ahead of newer records, so the next flush retries it in order
+            landed = e.complete_lines if isinstance(e, PartialWriteError) else 0
+            with self._lock:
+                self.pending_delta[:0] = records[landed:]
+                if new_phrases and landed <= len(records):
+                    self._retry_phrases = dict(new_phrases, **self._retry_phrases)
+            raise
+
+    def persist_delta(self):
+        """Flush pending training records and newly learned phrases as JSONL."""
+        self.write_delta(*self.take_delta())
+
+    def _flush_delta(self, bytes_buf):
+        """Submit one batched append to the training log."""
+        self.training_log.write(bytes_buf)
+        logger.debug(f"Flushed {len(bytes_buf)} bytes to {self.log_file}")
+
+    def save_model_state(self):
+        """Persist the fitted vectorizer, centroids, cluster labels and corpus rows for restarts and reader workers."""
+        with self._lock:
+            num_queries = len(self._clustered_labels)
+            state = {
+                "vectorizer": self.vectorizer,
+                "centroids": self._centroids,
+                "cluster_labels": self._clustered_labels,
+                "category_hits": dict(self.category_hits),
+                "num_queries": num_queries,
+                # Uncompressed, so reader workers mmap the rows and share one page-cached copy
+                "corpus": None if self._corpus_dense is None else self._corpus_dense[:num_queries],
+                "query_categories": self._query_categories[:num_queries]
+            }
+        tmp_file = self.model_file + ".tmp"
+        try:
+            # Replace rather than rewrite in place: readers may still have the previous file mapped
+            joblib.dump(state, tmp_file, compress=0)
+            os.chmod(tmp_file, 0o644)  # load_model_state refuses a group- or world-writable file
+            os.replace(tmp_file, self.model_file)
+            logger.debug(f"Saved model state to {self.model_file}")
+        except Exception as e:
+            logger.error(f"Error saving model state: {str(e)}")
+
+    def load_model_state(self):
+        """Restore the fitted model state, skipping the initial vectorizer fit."""
+        if not os.path.exists(self.model_file):
+            return
+        try:
+            st = os.stat(self.model_file)
+            self.model_mtime = st.st_mtime_ns
+            # Unpickling runs code, and the default path is in /tmp, so only trust a file no one else could have written
+            if hasattr(os, "getuid") and (st.st_uid != os.getuid() or st.st_mode & 0o022):
+                logger.error(f"Model state in {self.model_file} is not owned by this user or is writable by others, ignoring it")
+                return
+            state = joblib.load(self.model_file, mmap_mode="r")
+        except Exception as e:
+            logger.error(f"Error loading model state: {str(e)}")
+            return
+        num_queries = len(self.training_data["queries"])
+        if self.is_trainer and state["num_queries"] > num_queries:
+            logger.warning(f"Model state in {self.model_file} is newer than the training data, ignoring it")
+            return
+        if not isinstance(state["vectorizer"], HashedTfidfVectorizer):
+            logger.warning(f"Model state in {self.model_file} predates hashed TF-IDF, ignoring it")
+            return
+        self.vectorizer = state["vectorizer"]
+        self.vectorizer_fitted = True
+        self.build_query_transform()
+        self._centroids = state["centroids"]
+        self._full_retrain_at = -self.full_retrain_interval  # query_count is not persisted, so refit fully first
+        if self.is_trainer and not self._history_trimmed:
+            self.set_cluster_labels(state["cluster_labels"])
+            self._corpus_dense = None  # Rebuilt lazily against the loaded vocabulary
+        elif not self.is_trainer and state.get("corpus") is not None:
+            # Serve the trainer's published view straight from the mapped file instead of a private copy
+            self._shared_view = True
+            self._corpus_dense = state["corpus"]
+            self._corpus_size = self._corpus_dense.shape[0]
+            self._query_categories = list(state["query_categories"])
+            self.set_cluster_labels(state["cluster_labels"])
+        else:
+            self._shared_view = False  # Back to our own history, if we were serving the trainer's view
+            # The trainer's labels index its own history, so label ours against its centroids
+            self.rebuild_corpus()
+            self.set_cluster_labels(self.assign_clusters())
+        self.category_hits = Counter(state["category_hits"])
+        self.build_category_vectors()
+        self.build_classifier()
+        if not self._shared_view:
+            self.recategorize_queries()  # The loaded hits just reordered the classifier's priority
+        logger.info(f"Loaded model state from {self.model_file}")
+        if self.is_trainer and self._history_trimmed:
+            self._history_trimmed = False
+            self.save_model_state()  # Republish labels that index the trimmed history
+
+    def acquire_trainer_lock(self):
+        """Elect a single trainer among the workers sharing the data file."""
+        if fcntl is None:
+            return True
+        self._trainer_lock = open(self.data_file + ".lock", 'w')
+        try:
+            fcntl.flock(self._trainer_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            logger.info("Acquired trainer lock, this worker trains the model")
+            return True
+        except OSError:
+            logger.info("Another worker holds the trainer lock, running read-only")
+            return False
+
+    def refresh_model_state(self):
+        """Reload the trainer's published model state when it changes on disk."""
+        try:
+            mtime = os.stat(self.model_file).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self.model_mtime:
+            self.load_model_state()
+
+    def assign_clusters(self):
+        """Label the query history with its nearest centroids."""
+        if self._centroids is None or not self._corpus_size:
+            return [-1] * self._corpus_size
+        return (self._corpus_dense[:self._corpus_size] @ self._centroids.T).argmax(axis=1)
+
+    def set_cluster_labels(self, labels):
+        """Store new cluster labels; queries added since clustering are implicitly -1."""
+        self._clustered_labels = labels = np.asarray(labels, dtype=np.int32)
+        self._cluster_counts = np.bincount(labels[labels != -1], minlength=self.num_clusters)
 
-    def custom_cluster(self, features):
-        """Simplified clustering for performance."""
-        if features.shape[0] < self.num_clusters:
-            return [-1] * features.shape[0]
+    def rebuild_corpus(self, dense=None):
+        """Rebuild the dense corpus matrix after the vectorizer is (re)fitted."""
+        if dense is None:
+            dense = self.vectorizer.transform(self.training_data["queries"]).toarray()
+        self._corpus_dense = dense
+        self._corpus_size = dense.shape[0]
+
+    def append_corpus_row(self, query):
+        """Append one query's TF-IDF row to the corpus, doubling capacity when full."""
+        row = self.transform_query(query)
+        if self._corpus_size == self._corpus_dense.shape[0]:
+            grown = np.empty((max(2 * self._corpus_size, 64), row.shape[1]), dtype=np.float32)
+            grown[:self._corpus_size] = self._corpus_dense[:self._corpus_size]
+            self._corpus_dense = grown
+        row.toarray(out=self._corpus_dense[self._corpus_size:self._corpus_size + 1])
+        self._corpus_size += 1
+
+    def custom_cluster(self, dense):
+        """Cluster dense float32 query features, using mini-batch k-means once the corpus is large."""
+        if dense.shape[0] < self.num_clusters:
+            return [-1] * dense.shape[0], None
         try:
-            indices = random.sample(range(features.shape[0]), self.num_clusters)
-            centroids = features[indices].toarray()
-            labels = np.zeros(features.shape[0], dtype=int)
-            for _ in range(10):
-                distances = np.array([np.sum((features.toarray() - c) ** 2, axis=1) for c in centroids]).T
-                new_labels = np.argmin(distances, axis=1)
-                if np.array_equal(labels, new_labels):
-                    break
-                labels = new_labels
-                for k in range(self.num_clusters):
-                    cluster_points = features[labels == k].toarray()
-                    if cluster_points.shape[0] > 0:
-                        centroids[k] = np.mean(cluster_points, axis=0)
-            return labels.tolist()
+            if dense.shape[0] >= self.minibatch_min_samples:
+                # tol enables early stopping on small centroid moves; the default 0.0 only stops on stalled inertia
+                km = MiniBatchKMeans(n_clusters=self.num_clusters, n_init=3, batch_size=256, tol=1e-4).fit(dense)
+                labels, centroids = km.labels_, km.cluster_centers_
+            else:
+                labels, centroids = self.lloyd(dense)
+            return labels, normalize(centroids.astype(np.float32, copy=False))
         except Exception as e:
             logger.error(f"Error during clustering: {str(e)}")
-            return [-1] * features.shape[0]
+            return [-1] * dense.shape[0], None
+
+    def lloyd(self, dense, max_iter=10):
+        """Vectorized Lloyd's k-means on a dense float32 matrix."""
+        # k-means++ seeding spreads the initial centroids, so clusters collapse far less than with uniform picks
+        centroids, _ = kmeans_plusplus(dense, self.num_clusters, random_state=int(self._np_rng.integers(2 ** 31)))
+        if lloyd_kernel is not None:
+            return lloyd_kernel(dense, centroids, max_iter), centroids
+        n = dense.shape[0]
+        labels = np.zeros(n, dtype=np.int32)
+        row_norms = np.einsum("ij,ij->i", dense, dense)
+        ones = np.ones(n, dtype=np.float32)
+        rows = np.arange(n)
+        for _ in range(max_iter):
+            # ||x - c||^2 as one (N, K) GEMM instead of an (N, K, V) broadcast
+            distances = row_norms[:, None] - 2 * (dense @ centroids.T) + np.einsum("ij,ij->i", centroids, centroids)
+            new_labels = distances.argmin(axis=1).astype(np.int32)
+            if np.array_equal(labels, new_labels):
+                break
+            labels = new_labels
+            # Segment sum as a one-hot (K, N) assignment matrix times the data; np.add.at is unbuffered and slow
+            sums = csr_matrix((ones, (labels, rows)), shape=(self.num_clusters, n)) @ dense
+            counts = np.bincount(labels, minlength=self.num_clusters).astype(np.float32)  # Keeps the division in float32
+            occupied = counts > 0
+            centroids[occupied] = sums[occupied] / counts[occupied, None]
+        return labels, centroids
+
+    def build_query_transform(self):
+        """Build the cached single-query transform for the current vectorizer."""
+        vectorizer = self.vectorizer
+
+        @lru_cache(maxsize=1024)
+        def transform_query(query):
+            """Float32 TF-IDF row of one query; shared between callers, so never mutate it."""
+            return vectorizer.transform([query])
+
+        # Rebuilt whenever the vectorizer is refitted or swapped, which also drops stale rows
+        self.transform_query = transform_query
 
     def ensure_vectorizer_fitted(self):
         """Ensure the vectorizer is fitted if training data exists."""
         if not self.vectorizer_fitted and self.training_data["queries"]:
             try:
-                self.vectorizer.fit(self.training_data["queries"])
+                features = self.vectorizer.fit_counts(self.query_counts(self.training_data["queries"]))
+                self.rebuild_corpus(features.toarray())
                 self.vectorizer_fitted = True
+                self.build_query_transform()
+                self.build_category_vectors()
                 logger.debug("Fitted TF-IDF vectorizer")
             except Exception as e:
                 logger.error(f"Failed to fit vectorizer: {str(e)}")
 
     def train_model(self, query, generated_response=None, response=None, category=None, intent=None):
-        """Train the model with optimized updates."""
+        """Record a query for training and flag a retrain when one is due."""
+        with self._lock:
+            self.query_count += 1
+            query_count = self.query_count
+            record = {
+                "query": query, "intent": intent, "response": generated_response, "category": category,
+                "worker": self.worker_id
+            }
+            self.apply_delta(record)
+            self.pending_delta.append(record)
+            if self._corpus_dense is not None and not self._shared_view:
+                self.append_corpus_row(query)
+            # The trainer evicts when it swaps in a retrain; readers evict in batches to amortize the shift
+            if not self.is_trainer and len(self.training_data["queries"]) > self.max_history + self.max_history // 10:
+                self.evict_history(len(self.training_data["queries"]) - self.max_history)
+        if query_count % self.save_interval == 0:
+            self.persist_due = True
+        if self.is_trainer:
+            self.note_new_queries(1)
+
+    def query_counts(self, queries):
+        """Hashed term counts for a snapshot of the query history, hashing only queries new since the last fit."""
+        cached = self._query_counts
+        if cached is None:
+            cached = self.vectorizer.count(queries)
+        elif cached.shape[0] < len(queries):
+            cached = vstack([cached, self.vectorizer.count(queries[cached.shape[0]:])], format="csr")
+        self._query_counts = cached
+        return cached[:len(queries)]
+
+    def note_new_queries(self, count):
+        """Trainer: count newly recorded queries and flag a retrain once train_interval have arrived."""
+        with self._lock:
+            self._queries_since_retrain += count
+            if self._retrain_pending:
+                return  # The queued retrain will pick these up
+            if self._queries_since_retrain >= self.train_interval and len(self.training_data["queries"]) >= self.num_clusters:
+                self._queries_since_retrain = 0
+                self._retrain_pending = True
+                self.retrain_due = True
+
+    def sync_training_log(self):
+        """Trainer: apply queries other workers have logged, so they reach the corpus and the next retrain."""
+        applied = self.tail_training_log()
+        if applied:
+            logger.debug(f"Applied {applied} training log records from other workers")
+            self.note_new_queries(applied)
+
+    def update_clusters_online(self):
+        """Batched MacQueen update: assign queries added since clustering to their nearest centroids and move
+        those centroids to the running mean. False if the labels no longer line up with the corpus."""
         start_time = time.time()
-        self.query_count += 1
-        self.training_data["queries"].append(query)
-        self.training_data["cluster_labels"].append(-1)
-        if intent:
-            self.training_data["intent_mappings"][query.lower()] = intent
-        if generated_response and category:
-            self.training_data["generated_responses"].setdefault(category, []).append(generated_response)
-            self.training_data["used_responses"].setdefault(category, set()).add(generated_response)
-        if self.query_count % self.train_interval == 0 and len(self.training_data["queries"]) >= self.num_clusters:
-            features = self.vectorizer.fit_transform(self.training_data["queries"])
-            self.vectorizer_fitted = True
-            self.training_data["cluster_labels"] = self.custom_cluster(features)
-            self.save_training_data()
-            logger.info(f"Model trained in {time.time() - start_time:.3f} seconds")
-        elif self.query_count % self.save_interval == 0:
-            self.save_training_data()
+        with self._lock:
+            if self._corpus_dense is None:
+                self.rebuild_corpus()
+            start, size = len(self._clustered_labels), self._corpus_size
+            if start > size:
+                return False
+            # Rows below size never change in place, and only this thread evicts, so the view is safe unlocked
+            new_rows = self._corpus_dense[start:size]
+            centroids, counts = self._centroids, self._cluster_counts
+        if not len(new_rows):
+            return True
+        new_labels = (new_rows @ centroids.T).argmax(axis=1).astype(np.int32)
+        added = np.bincount(new_labels, minlength=self.num_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, new_labels, new_rows)
+        moved = np.flatnonzero(added)
+        centroids = np.array(centroids)  # Copied, as the loaded centroids may be a read-only mmap
+        totals = (counts[moved] + added[moved])[:, None]
+        centroids[moved] = normalize((counts[moved, None] * centroids[moved] + sums[moved]) / totals)
+        with self._lock:
+            self._centroids = centroids
+            self.set_cluster_labels(np.concatenate((self._clustered_labels, new_labels)))
+            excess = len(self.training_data["queries"]) - self.max_history
+            if excess > 0:
+                self.evict_history(excess)
+        self.save_model_state()
+        logger.info(f"Clusters updated online with {len(new_labels)} queries in {time.time() - start_time:.3f} seconds")
+        return True
 
-    def get_query_category(self, query):
-        """Fast category detection for queries."""
-        query_lower = query.lower()
-        for category, info in self.query_response_map.items():
-            if any(keyword.lower() in query_lower for keyword in info["keywords"]):
-                return category
-        return None
+    def retrain(self):
+        """Refit the vectorizer and recluster on a snapshot of the queries, or update the clusters online in between."""
+        self.tail_training_log()
+        with self._lock:
+            self._retrain_pending = False
+            self._queries_since_retrain = 0
+            online = self._centroids is not None and self.query_count - self._full_retrain_at < self.full_retrain_interval
+        if online and self.update_clusters_online():
+            return
+        start_time = time.time()
+        with self._lock:
+            queries = list(self.training_data["queries"])
+            self._full_retrain_at = self.query_count
+        counts = self.query_counts(queries)
+        refit = not self.vectorizer_fitted or self.vectorizer.vocabulary_overlap(counts) < self.stable_vocabulary_overlap
+        if refit:
+            vectorizer = copy.copy(self.vectorizer)  # fit_counts rebinds its fitted attributes, leaving ours intact
+            # Densified once; the same matrix feeds clustering and becomes the new corpus
+            dense = vectorizer.fit_counts(counts).toarray()
+        else:
+            # Vocabulary is stable, so recluster the existing corpus rows; rows below the snapshot never change
+            with self._lock:
+                if self._corpus_dense is None:
+                    self.rebuild_corpus()
+                dense = self._corpus_dense[:len(queries)]
+        labels, centroids = self.custom_cluster(dense)
+        with self._lock:
+            if refit:
+                self.vectorizer = vectorizer
+                self.vectorizer_fitted = True
+                self.build_query_transform()
+                self.rebuild_corpus(dense)
+                for query in self.training_data["queries"][len(queries):]:
+                    self.append_corpus_row(query)
+                self.build_category_vectors()
+            self._centroids = centroids
+            self.set_cluster_labels(labels)
+            excess = len(self.training_data["queries"]) - self.max_history
+            if excess > 0:
+                self.evict_history(excess)
+            self.build_classifier()
+            self.recategorize_queries()  # Published with the model, so readers see the new priority too
+        self.save_model_state()
+        logger.info(f"Model trained in {time.time() - start_time:.3f} seconds{'' if refit else ' (vectorizer kept)'}")
+
+    def recategorize_queries(self):
+        """Resolve every stored query's category against the classifier's current priority."""
+        self._query_categories = [self.match_category(query.lower()) for query in self.training_data["queries"]]
+
+    def build_classifier(self):
+        """Build the cached keyword matcher, with the most frequently hit categories taking priority."""
+        categories = sorted(self._response_table, key=lambda category: -self.category_hits[category])
+        keyword_index = {}  # keyword -> (rank, category) of the best-ranked category using it
+        for rank, category in enumerate(categories):
+            for keyword in self._response_table[category][0]:
+                keyword_index.setdefault(keyword.lower(), (rank, category))
+        if ahocorasick is not None:
+            automaton = ahocorasick.Automaton()
+            for keyword, match in keyword_index.items():
+                automaton.add_word(keyword, match)
+            automaton.make_automaton()
+            match_keywords = lambda q: (match for _, match in automaton.iter(q))
+        else:
+            # One capture group per category in rank order, so at each position the lookahead captures
+            # the best-ranked category and its group index is the rank; categories left without
+            # keywords get a never-matching group to keep indices aligned
+            by_rank = [[] for _ in categories]
+            for keyword, (rank, _) in keyword_index.items():
+                by_rank[rank].append(re.escape(keyword))
+            pattern = re.compile("(?=" + "|".join(
+                "(" + ("|".join(keywords) if keywords else "(?!)") + ")" for keywords in by_rank
+            ) + ")")
+            match_keywords = lambda q: (
+                (m.lastindex - 1, categories[m.lastindex - 1]) for m in pattern.finditer(q)
+            )
+
+        @lru_cache(maxsize=4096)
+        def match_category(query_lower):
+            """Match a lowercased query to its best-ranked category without counting the hit."""
+            match = min(match_keywords(query_lower), default=None)
+            return None if match is None else match[1]
+
+        # Swapped in whole, so a rebuild after retraining also starts with an empty cache
+        self.match_category = match_category
+
+    def get_query_category(self, query_lower):
+        """Fast category detection for lowercased queries."""
+        category = self.match_category(query_lower)
+        if category:
+            self.category_hits[category] += 1
+        return category
+
+    def pick_unused_response(self, responses, used_responses, persistent_used, attempts=4):
+        """Pick a random response not used yet, or None if every response has been used."""
+        rng = self._rng
+        for _ in range(attempts):
+            response = rng.choice(responses)
+            if response not in used_responses and response not in persistent_used:
+                return response
+        # Most responses are used; fall back to an exact scan so a remaining one is never missed
+        available = [r for r in responses if r not in used_responses and r not in persistent_used]
+        return rng.choice(available) if available else None
 
-    def generate_new_response(self, query, category):
-        """Generate a unique response for a query."""
+    def generate_new_response(self, query_lower, category):
+        """Generate a unique response for a lowercased query."""
         start_time = time.time()
-        used_responses = self.training_data["used_responses"].get(category, set())
-        templates = [
-            "For {query}, {action}",
-            "Regarding {query}, {action}",
-            "About {query}, {action}"
-        ]
-        actions = [
-            "please check our website for more details",
-            "visit our support page for assistance",
-            "contact our team for further assistance",
-            "refer to our FAQ for quick answers"
-        ]
+        used_responses = self.training_data["used_responses"].setdefault(category, set())
+        parts = self.new_response_parts
         max_attempts = 5
+        choice = self._rng.choice
         for _ in range(max_attempts):
-            action = random.choice(actions)
-            new_response = random.choice(templates).format(query=query.lower(), action=action)
+            prefix, suffix = choice(parts)
+            new_response = prefix + query_lower + suffix
             if new_response not in used_responses:
-                self.training_data["used_responses"].setdefault(category, set()).add(new_response)
+                used_responses.add(new_response)
                 self.training_data["generated_responses"].setdefault(category, []).append(new_response)
                 logger.debug(f"Generated new response in {time.time() - start_time:.3f} seconds")
                 return new_response
-        new_response = random.choice(templates).format(query=query.lower(), action=random.choice(actions))
+        prefix, suffix = choice(parts)
+        new_response = prefix + query_lower + suffix
         logger.debug(f"Fallback response in {time.time() - start_time:.3f} seconds")
         return new_response
 
-    def generate_initial_response(self, query, category=None):
+    def generate_initial_response(self, query, category=None, query_lower=None, intent=None):
         """Generate an initial response for a query."""
         start_time = time.time()
-        query_key = query.lower()
-        used_responses = self.used_response_sets[query_key]
+        if query_lower is None:
+            query_lower = sys.intern(query.lower())
+        used_responses = self.used_response_sets[query_lower]
         persistent_used = self.training_data["used_responses"].get(category, set())
-        intent = self.personalized_ai.detect_intent(query)
-        self.personalized_ai.learn_phrase(query, intent)
-        if category and category in self.query_response_map:
-            available_responses = [
-                r for r in self.query_response_map[category]["responses"]
-                if r not in used_responses and r not in persistent_used
-            ]
-            if not available_responses:
-                response = self.generate_new_response(query, category)
+        if intent is None:
+            intent = self.personalized_ai.detect_intent(query_lower)
+        self.personalized_ai.learn_phrase(query_lower, intent)
+        if category and category in self._response_table:
+            response = self.pick_unused_response(self._response_table[category][1], used_responses, persistent_used)
+            if response is None:
+                response = self.generate_new_response(query_lower, category)
                 self.train_model(query, response, category, intent)
-                self.used_response_sets[query_key].add(response)
+                used_responses.add(response)
                 logger.info(f"Generated new response for '{query}' in {time.time() - start_time:.3f} seconds")
                 return response
-            response = random.choice(available_responses)
-            self.used_response_sets[query_key].add(response)
+            used_responses.add(response)
             self.training_data["used_responses"].setdefault(category, set()).add(response)
             self.train_model(query, response, category, intent)
         else:
-            response = self.personalized_ai.generate_response(query, used_responses)
+            response = self.personalized_ai.generate_response(query_lower, used_responses, intent)
             self.train_model(query, response, None, intent)
-            self.used_response_sets[query_key].add(response)
+            used_responses.add(response)
         logger.info(f"Initial response for '{query}' in {time.time() - start_time:.3f} seconds")
         return response
 
-    def find_similar_query(self, query, features, query_features):
-        """Find a similar query using cosine similarity."""
+    def build_category_vectors(self):
+        """Precompute one normalized TF-IDF vector per category from its keywords."""
+        self._category_vectors = normalize(self.vectorizer.transform_counts(self._category_counts).toarray())
+
+    def dense_query_vector(self, query_features):
+        """Densify a sparse query row into the reused float32 buffer and L2-normalize it in place."""
+        row = query_features.astype(np.float32, copy=False)
+        if self._query_scratch is None or self._query_scratch.shape != row.shape:
+            self._query_scratch = np.empty(row.shape, dtype=np.float32)
+        q = row.toarray(out=self._query_scratch)[0]
+        norm = np.linalg.norm(q)
+        if norm > 0:
+            q /= norm
+        return q
+
+    def category_from_features(self, q):
+        """Pick the category whose keyword vector is closest to the dense query vector, if close enough."""
+        if self._category_vectors is None:
+            return None
+        scores = self._category_vectors @ q
+        best = int(scores.argmax())
+        return self._category_names[best] if scores[best] > 0.2 else None
+
+    def find_similar_query_index(self, q):
+        """Find the index of the most similar query by cosine similarity."""
         try:
-            similarities = cosine_similarity(query_features, features)[0]
-            max_similarity_idx = np.argmax(similarities)
+            if self._corpus_dense is None:
+                self.rebuild_corpus()
+            # One GEMV over the whole corpus is cheap at this size and always finds the global best match
+            similarities = self._corpus_dense[:self._corpus_size] @ q
+            max_similarity_idx = int(np.argmax(similarities))
             if similarities[max_similarity_idx] > 0.7:
-                return self.training_data["queries"][max_similarity_idx]
+                return max_similarity_idx
             return None
         except Exception as e:
             logger.error(f"Error finding similar query: {str(e)}")
             return None
 
-    def generate_response(self, query):
+    def generate_response(self, query, query_lower=None):
         """Generate a response with optimized flow."""
         start_time = time.time()
-        intent = self.personalized_ai.detect_intent(query)
+        if query_lower is None:
+            query_lower = sys.intern(query.lower())
+        if not self.is_trainer:
+            self.refresh_model_state()
+        intent = self.personalized_ai.detect_intent(query_lower)
         self.train_model(query, intent=intent)
-        category = self.get_query_category(query)
+        category = self.get_query_category(query_lower)
         if len(self.training_data["queries"]) < self.num_clusters:
-            response = self.generate_initial_response(query, category)
+            response = self.generate_initial_response(query, category, query_lower, intent)
             logger.info(f"Response for '{query}' generated in {time.time() - start_time:.3f} seconds")
             return response, "Success"
         self.ensure_vectorizer_fitted()
         if not self.vectorizer_fitted:
-            response = self.generate_initial_response(query, category)
+            response = self.generate_initial_response(query, category, query_lower, intent)
             logger.info(f"Response for '{query}' generated in {time.time() - start_time:.3f} seconds")
             return response, "Success"
-        query_features = self.vectorizer.transform([query])
-        features = self.vectorizer.transform(self.training_data["queries"])
-        similar_query = self.find_similar_query(query, features, query_features)
-        if similar_query:
-            similar_category = self.get_query_category(similar_query)
-            used_responses = self.used_response_sets[query.lower()]
+        with self._lock:
+            q = self.dense_query_vector(self.transform_query(query))
+            if category is None:
+                category = self.category_from_features(q)
+            similar_index = self.find_similar_query_index(q)
+            # Resolved under the same lock: an eviction on the retrain thread shifts these positions
+            similar_category = None if similar_index is None else self._query_categories[similar_index]
+        if similar_index is not None:
+            used_responses = self.used_response_sets[query_lower]
             persistent_used = self.training_data["used_responses"].get(similar_category, set())
-            if similar_category and similar_category in self.query_response_map:
-                available_responses = [
-                    r for r in self.query_response_map[similar_category]["responses"]
-                    if r not in used_responses and r not in persistent_used
-                ]
-                if not available_responses:
-                    response = self.generate_new_response(query, similar_category)
+            if similar_category and similar_category in self._response_table:
+                response = self.pick_unused_response(
+                    self._response_table[similar_category][1], used_responses, persistent_used
+                )
+                if response is None:
+                    response = self.generate_new_response(query_lower, similar_category)
                     self.train_model(query, response, similar_category, intent)
-                    self.used_response_sets[query.lower()].add(response)
+                    used_responses.add(response)
                 else:
-                    response = random.choice(available_responses)
-                    self.used_response_sets[query.lower()].add(response)
+                    used_responses.add(response)
                     self.training_data["used_responses"].setdefault(similar_category, set()).add(response)
                     self.train_model(query, response, similar_category, intent)
             else:
-                response = self.personalized_ai.generate_response(query, used_responses)
+                response = self.personalized_ai.generate_response(query_lower, used_responses, intent)
                 self.train_model(query, response, None, intent)
-                self.used_response_sets[query.lower()].add(response)
+                used_responses.add(response)
         else:
-            response = self.generate_initial_response(query, category)
+            response = self.generate_initial_response(query, category, query_lower, intent)
         logger.info(f"Response for '{query}' generated in {time.time() - start_time:.3f} seconds")
         return response, "Success"
 
 ai = CustomAI()
+retrain_executor = ThreadPoolExecutor(max_workers=1)  # Runs retrains off the request path, one at a time
+persist_executor = ThreadPoolExecutor(max_workers=1)  # Serializes and appends training log batches in order
+
+def log_task_failure(future):
+    """Log the exception of a background task that nobody awaits."""
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Background task failed: {str(future.exception())}", exc_info=future.exception())
 
-@app.post("/generate-response")
+def run_in_background(executor, func, *args):
+    """Run func on an executor without awaiting it, logging any failure."""
+    asyncio.get_running_loop().run_in_executor(executor, func, *args).add_done_callback(log_task_failure)
+
+@app.post("/generate-response", response_class=ORJSONResponse)
 async def generate_response(request: QueryRequest):
     """Generate a response for a user query."""
     query = request.query.strip()
     if not query:
-        raise HTTPException(status_code=400, detail="Query cannot be empty")
+        return ORJSONResponse({"detail": "Query cannot be empty"}, status_code=400)
+    query_lower = sys.intern(query.lower())  # Canonical key for every per-query lookup downstream
     try:
-        response, status = ai.generate_response(query)
-        return {
+        response, status = ai.generate_response(query, query_lower)
+        if ai.persist_due:
+            ai.persist_due = False
+            # Detach the delta here, between requests, and leave serialization and the write to the executor
+            run_in_background(persist_executor, ai.write_delta, *ai.take_delta())
+            if ai.is_trainer:
+                # Same executor as retrains, so log tailing and retraining never interleave
+                run_in_background(retrain_executor, ai.sync_training_log)
+        if ai.retrain_due:
+            ai.retrain_due = False
+            run_in_background(retrain_executor, ai.retrain)
+        return ORJSONResponse({
             "query": query,
             "response": response,
             "status": status
-        }
+        })
     except Exception as e:
         logger.error(f"API error: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}")
+        return ORJSONResponse({"detail": f"Error generating response: {str(e)}"}, status_code=500)
 
 if __name__ == "__main__":
     import uvicorn